@@ -0,0 +1,84 @@
+"""Measures chat store reads and writes per second under concurrent load.
+
+Run from the backend directory:
+
+    python -m benchmarks.chat_store_benchmark --threads 8 --seconds 5
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+from src import chat_manager
+
+
+def worker(chat_ids, read_ratio, deadline, counts, lock):
+    """Appends or reads random chats until the deadline."""
+    reads = writes = 0
+    rng = random.Random()
+    while time.perf_counter() < deadline:
+        chat_id = rng.choice(chat_ids)
+        if rng.random() < read_ratio:
+            chat_manager.get_chat_history(chat_id, limit=20)
+            reads += 1
+        else:
+            chat_manager.append_chat_messages(chat_id, [
+                {"sender": "user", "text": "What does the manual say about E42?"},
+                {"sender": "ai", "text": "Error E42 means the sensor is not calibrated."},
+            ])
+            writes += 1
+
+    with lock:
+        counts["reads"] += reads
+        counts["writes"] += writes
+
+
+def run(threads, seconds, chats, read_ratio):
+    """Runs the benchmark against a temporary database and returns the op counts.
+
+    chat_manager is pointed at the temporary database for the duration of
+    the run, so the configured chat history is never touched.
+    """
+    counts = {"reads": 0, "writes": 0}
+    lock = threading.Lock()
+    chat_ids = [f"bench-{i}" for i in range(chats)]
+    db_path = chat_manager.DB_PATH
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        chat_manager.DB_PATH = os.path.join(tmp_dir, "chat_history.db")
+        try:
+            chat_manager.init_chat_db()
+            deadline = time.perf_counter() + seconds
+            pool = [threading.Thread(target=worker,
+                                     args=(chat_ids, read_ratio, deadline, counts, lock))
+                    for _ in range(threads)]
+            for thread in pool:
+                thread.start()
+            for thread in pool:
+                thread.join()
+        finally:
+            chat_manager.DB_PATH = db_path
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--read-ratio", type=float, default=0.8)
+    args = parser.parse_args()
+
+    counts = run(args.threads, args.seconds, args.chats, args.read_ratio)
+
+    print(f"threads={args.threads} seconds={args.seconds} read_ratio={args.read_ratio}")
+    print(f"reads/sec:  {counts['reads'] / args.seconds:,.0f}")
+    print(f"writes/sec: {counts['writes'] / args.seconds:,.0f} "
+          f"({2 * counts['writes'] / args.seconds:,.0f} messages/sec)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""Runs the whole RAG pipeline offline and reports throughput and latency per stage.
+
+A synthetic PDF corpus is generated in a temporary working directory and
+ingested with the real preprocessing, embedding and ChromaDB code. OpenAI is
+replaced by the local fakes in benchmarks/fakes.py. The stages are:
+
+  - extraction: pages/sec and chunks/sec of process_all_pdfs()
+  - embedding: embedding batches/sec and ChromaDB insert rate of embed_pdfs()
+  - ask: p50/p95/p99 latency of POST /ask/ under concurrent load
+  - chat store: reads and writes/sec, see chat_store_benchmark
+
+With --baseline, the results are compared with an earlier --output file and
+the run fails if any metric got worse by more than --tolerance.
+
+Run from the backend directory:
+
+    python -m benchmarks.e2e_benchmark --docs 20 --pages 30 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import httpx
+import numpy as np
+from benchmarks.fakes import FakeChatModel, FakeEmbeddingFunction, FakeEmbeddings
+
+
+WORDS = """pump valve sensor motor pressure temperature calibration filter
+voltage current relay fuse controller display alarm reset firmware update
+inspection maintenance interval torque bearing seal gasket coolant flow
+""".split()
+
+# Metrics where a lower value is better; all others are throughputs.
+LATENCY_METRICS = {"ask_p50_ms", "ask_p95_ms", "ask_p99_ms"}
+
+
+def pdf_escape(text):
+    """Escapes a string for use in a PDF text object."""
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, pages):
+    """Writes a minimal PDF with one Helvetica text line per entry of each page."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>",
+               f"<< /Type /Pages /Kids [{' '.join(f'{4 + 2 * i} 0 R' for i in range(len(pages)))}] "
+               f"/Count {len(pages)} >>",
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    for i, lines in enumerate(pages):
+        objects.append("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>")
+        stream = "BT /F1 9 Tf 36 760 Td 11 TL " + " ".join(
+            f"({pdf_escape(line)}) '" for line in lines) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+
+    out = "%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n"
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    with open(path, "w", encoding="latin-1") as f:
+        f.write(out)
+
+
+def make_corpus(directory, docs, pages, lines, rng):
+    """Writes `docs` synthetic manuals of `pages` pages each. Returns the page count."""
+    os.makedirs(directory, exist_ok=True)
+    for doc in range(docs):
+        write_pdf(os.path.join(directory, f"manual_{doc:04d}.pdf"), [
+            [f"Error E{doc}-{page}-{line}: " + " ".join(rng.choices(WORDS, k=10))
+             for line in range(lines)]
+            for page in range(pages)
+        ])
+    return docs * pages
+
+
+class TimedCollection:
+    """Wraps a ChromaDB collection and measures the time spent in add()."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.records = 0
+        self.seconds = 0.0
+
+    def add(self, **kwargs):
+        start = time.perf_counter()
+        self.collection.add(**kwargs)
+        self.seconds += time.perf_counter() - start
+        self.records += len(kwargs["ids"])
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+async def run_ask_load(app, questions, concurrency):
+    """Sends the questions to /ask/ with at most `concurrency` in flight. Returns latencies in ms."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def ask(client, question):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post("/ask/", json={"question": question}, timeout=None)
+            response.raise_for_status()
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        await asyncio.gather(*(ask(client, question) for question in questions))
+    return latencies
+
+
+def run_pipeline(args, rng):
+    """Runs all stages in the current working directory and returns the metrics."""
+    # The application reads its paths from settings at import time, so it may
+    # only be imported once the working directory is the benchmark directory.
+    from src import embedding, preprocessing, retrieval
+    from src.api import app
+    from src.metrics import llm_metrics_callback
+    from src.retriever import CachedQueryEmbeddings
+    from src.settings import settings
+    from benchmarks.chat_store_benchmark import run as run_chat_store
+
+    metrics = {}
+
+    total_pages = make_corpus(preprocessing.RAW_DIR, args.docs, args.pages, args.lines, rng)
+    start = time.perf_counter()
+    preprocessing.process_all_pdfs()
+    seconds = time.perf_counter() - start
+    pdf_names = embedding.list_processed_pdfs()
+    total_chunks = sum(len(embedding.load_chunks(pdf_name)) for pdf_name in pdf_names)
+    metrics["extraction_pages_per_sec"] = total_pages / seconds
+    metrics["extraction_chunks_per_sec"] = total_chunks / seconds
+
+    embedding_function = FakeEmbeddingFunction(args.dim, args.embed_latency)
+    client = embedding.get_persistent_client()
+    collection = TimedCollection(client.get_or_create_collection(
+        name=settings["COLLECTION_NAME"], embedding_function=None))
+    start = time.perf_counter()
+    embedding.embed_pdfs(collection, embedding_function,
+                         embedding.get_embedding_batch_size(client), pdf_names)
+    embedding.save_keyword_index()
+    seconds = time.perf_counter() - start
+    metrics["embedding_batches_per_sec"] = embedding_function.stats.calls / seconds
+    metrics["embedding_chunks_per_sec"] = total_chunks / seconds
+    metrics["chroma_inserts_per_sec"] = collection.records / collection.seconds
+
+    os.environ["OPENAI_API_KEY"] = "offline-benchmark"
+    retrieval.build_llm = lambda api_key: FakeChatModel(
+        answer_tokens=args.answer_tokens, first_token_latency=args.llm_latency,
+        token_latency=args.token_latency, callbacks=[llm_metrics_callback])
+    retrieval.build_embeddings = lambda api_key: CachedQueryEmbeddings(
+        FakeEmbeddings(args.dim, args.embed_latency), "fake")
+    retrieval.initialize_chain(force=True)
+
+    questions = [f"What does error E{rng.randrange(args.docs)}-{rng.randrange(args.pages)}-"
+                 f"{rng.randrange(args.lines)} mean for the {rng.choice(WORDS)}? ({i})"
+                 for i in range(args.requests)]
+    start = time.perf_counter()
+    latencies = asyncio.run(run_ask_load(app, questions, args.concurrency))
+    seconds = time.perf_counter() - start
+    metrics["ask_requests_per_sec"] = len(latencies) / seconds
+    for percentile in (50, 95, 99):
+        metrics[f"ask_p{percentile}_ms"] = float(np.percentile(latencies, percentile))
+
+    counts = run_chat_store(args.threads, args.chat_seconds, 100, 0.8)
+    metrics["chat_reads_per_sec"] = counts["reads"] / args.chat_seconds
+    metrics["chat_writes_per_sec"] = counts["writes"] / args.chat_seconds
+
+    metrics.update(pages=total_pages, chunks=total_chunks)
+    return metrics
+
+
+def compare(metrics, baseline, tolerance):
+    """Returns the metrics that regressed by more than `tolerance` against the baseline."""
+    regressions = []
+    for name, value in metrics.items():
+        before = baseline.get(name)
+        if not before or name in ("pages", "chunks"):
+            continue
+        change = (value - before) / before
+        if name in LATENCY_METRICS:
+            change = -change
+        if change < -tolerance:
+            regressions.append((name, before, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--docs", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=30)
+    parser.add_argument("--lines", type=int, default=40)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--extractor", default="pdfium")
+    parser.add_argument("--workers", type=int, default=0, help="Extraction workers (0: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="Seconds per embedding call")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="Seconds to the first token")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="Seconds per further token")
+    parser.add_argument("--answer-tokens", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--threads", type=int, default=8, help="Chat store threads")
+    parser.add_argument("--chat-seconds", type=float, default=3.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the metrics to this JSON file")
+    parser.add_argument("--baseline", help="Fail if metrics regressed against this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix="rag-benchmark-")
+    os.makedirs(os.path.join(work_dir, "settings"))
+    with open(os.path.join(work_dir, "settings", "settings.json"), "w", encoding="utf-8") as f:
+        json.dump({"PDF_EXTRACTOR": args.extractor, "EXTRACTION_WORKERS": args.workers,
+                   "EMBEDDING_BATCH_SIZE": args.batch_size, "EMBEDDING_CACHE": False,
+                   "ANSWER_CACHE": False, "HISTORY_SUMMARY": False}, f)
+
+    os.chdir(work_dir)
+    try:
+        metrics = run_pipeline(args, random.Random(args.seed))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"\ndocs={args.docs} pages={metrics['pages']} chunks={metrics['chunks']} "
+          f"concurrency={args.concurrency} extractor={args.extractor}")
+    for name, value in metrics.items():
+        if name not in ("pages", "chunks"):
+            print(f"{name:<28} {value:12,.1f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(metrics, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(metrics, json.load(f), args.tolerance)
+        for name, before, after in regressions:
+            print(f"REGRESSION {name}: {before:,.1f} -> {after:,.1f}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
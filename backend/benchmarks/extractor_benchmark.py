@@ -0,0 +1,102 @@
+"""Compares the PDF text extractors by speed and by agreement with pdfplumber.
+
+For each backend, every PDF is extracted once and pages per second are
+reported. Fidelity is the word-level F1 score of each page's text against
+pdfplumber's text for the same page, averaged over all pages.
+
+Run from the backend directory on a directory of PDFs or single files:
+
+    python -m benchmarks.extractor_benchmark data/raw/
+"""
+import argparse
+import os
+import re
+import time
+from collections import Counter
+from functools import partial
+
+import numpy as np
+import pypdfium2 as pdfium
+from src.extractors import EXTRACTORS, extract_pages_pdfium
+from src.settings import settings
+
+
+WORD_PATTERN = re.compile(r"\w+")
+
+BACKENDS = {
+    **EXTRACTORS,
+    "pdfium-no-fallback": partial(extract_pages_pdfium, fallback=False),
+}
+
+
+def find_pdfs(paths):
+    """Expands directories into the PDF files they contain."""
+    pdfs = []
+    for path in paths:
+        if os.path.isdir(path):
+            pdfs.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                        if name.endswith(".pdf"))
+        else:
+            pdfs.append(path)
+    return pdfs
+
+
+def count_pages(pdf_path):
+    """Returns the number of pages of a PDF."""
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
+def word_f1(text, reference):
+    """Returns the F1 score of the words of `text` against `reference`."""
+    words, expected = Counter(WORD_PATTERN.findall(text.lower())), Counter(
+        WORD_PATTERN.findall(reference.lower()))
+    if not words and not expected:
+        return 1.0
+    overlap = sum((words & expected).values())
+    if overlap == 0:
+        return 0.0
+    precision = overlap / sum(words.values())
+    recall = overlap / sum(expected.values())
+    return 2 * precision * recall / (precision + recall)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="*", default=[settings["PDF_RAW"]])
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=list(BACKENDS))
+    args = parser.parse_args()
+
+    pdfs = find_pdfs(args.paths)
+    if not pdfs:
+        parser.error("no PDF files found")
+    total_pages = sum(count_pages(pdf) for pdf in pdfs)
+
+    texts = {}
+    for backend in ["pdfplumber"] + [b for b in args.backends if b != "pdfplumber"]:
+        extract = BACKENDS[backend]
+        pages = {}
+        start = time.perf_counter()
+        for pdf in pdfs:
+            for page_number, text in extract(pdf):
+                pages[(pdf, page_number)] = text
+        seconds = time.perf_counter() - start
+        texts[backend] = pages
+
+        reference = texts["pdfplumber"]
+        keys = set(reference) | set(pages)
+        fidelity = np.mean([word_f1(pages.get(key, ""), reference.get(key, ""))
+                            for key in keys]) if keys else 1.0
+        if backend in args.backends:
+            print(f"{backend:<20} {total_pages / seconds:8.1f} pages/s  {seconds:7.2f} s  "
+                  f"{len(pages):6d} pages with text  {sum(map(len, pages.values())):10d} chars  "
+                  f"word F1 vs pdfplumber {fidelity:.3f}")
+
+    print(f"{len(pdfs)} PDFs, {total_pages} pages")
+
+
+if __name__ == "__main__":
+    main()
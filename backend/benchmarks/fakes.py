@@ -0,0 +1,152 @@
+"""Deterministic local stand-ins for the OpenAI clients, for offline benchmarks.
+
+Embeddings are hashed bags of words, so texts that share words get similar
+vectors and retrieval behaves plausibly. Every client sleeps for a
+configurable time per call to model network and inference latency.
+"""
+import asyncio
+import hashlib
+import re
+import threading
+import time
+from typing import Any, AsyncIterator, Iterator
+
+import numpy as np
+from chromadb.api.types import EmbeddingFunction
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def hash_embedding(text, dim):
+    """Returns a unit vector built by hashing the words of the text into `dim` buckets."""
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in WORD_PATTERN.findall(text.lower()):
+        digest = hashlib.blake2b(word.encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        vector[value % dim] += 1.0 if value >> 63 else -1.0
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        vector[0] = norm = 1.0
+    return vector / norm
+
+
+class CallStats:
+    """Thread-safe count of calls, inputs and time spent in a fake client."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = self.inputs = 0
+        self.seconds = 0.0
+
+    def record(self, inputs, seconds):
+        with self.lock:
+            self.calls += 1
+            self.inputs += inputs
+            self.seconds += seconds
+
+
+class FakeEmbeddingFunction(EmbeddingFunction):
+    """ChromaDB embedding function replacing OpenAIEmbeddingFunction for ingestion."""
+
+    def __init__(self, dim=512, latency=0.05):
+        self.dim = dim
+        self.latency = latency
+        self.stats = CallStats()
+
+    def __call__(self, input):
+        start = time.perf_counter()
+        time.sleep(self.latency)
+        vectors = [hash_embedding(text, self.dim).tolist() for text in input]
+        self.stats.record(len(input), time.perf_counter() - start)
+        return vectors
+
+
+class FakeEmbeddings(Embeddings):
+    """LangChain embeddings replacing OpenAIEmbeddings for queries."""
+
+    def __init__(self, dim=512, latency=0.05):
+        self.dim = dim
+        self.latency = latency
+        self.stats = CallStats()
+
+    def embed_documents(self, texts):
+        start = time.perf_counter()
+        time.sleep(self.latency)
+        vectors = [hash_embedding(text, self.dim).tolist() for text in texts]
+        self.stats.record(len(texts), time.perf_counter() - start)
+        return vectors
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency)
+        vectors = [hash_embedding(text, self.dim).tolist() for text in texts]
+        self.stats.record(len(texts), time.perf_counter() - start)
+        return vectors
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model replacing ChatOpenAI that streams a canned answer.
+
+    The first token arrives after `first_token_latency` seconds and each
+    further token after `token_latency` seconds.
+    """
+
+    answer_tokens: int = 50
+    first_token_latency: float = 0.3
+    token_latency: float = 0.01
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    def tokens(self):
+        return [f"token{i} " for i in range(self.answer_tokens)]
+
+    def delays(self):
+        return [self.first_token_latency] + [self.token_latency] * (self.answer_tokens - 1)
+
+    def usage(self, messages):
+        """Returns usage metadata like OpenAI's, counting about four characters per prompt token."""
+        input_tokens = sum(len(str(message.content)) for message in messages) // 4
+        return {"input_tokens": input_tokens, "output_tokens": self.answer_tokens,
+                "total_tokens": input_tokens + self.answer_tokens}
+
+    def result(self, messages):
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(
+            content="".join(self.tokens()), usage_metadata=self.usage(messages)))])
+
+    def chunks(self, messages):
+        tokens = self.tokens()
+        for i, (token, delay) in enumerate(zip(tokens, self.delays())):
+            usage = self.usage(messages) if i == len(tokens) - 1 else None
+            yield delay, ChatGenerationChunk(message=AIMessageChunk(content=token, usage_metadata=usage))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        time.sleep(sum(self.delays()))
+        return self.result(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(sum(self.delays()))
+        return self.result(messages)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        for delay, chunk in self.chunks(messages):
+            time.sleep(delay)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        for delay, chunk in self.chunks(messages):
+            await asyncio.sleep(delay)
+            yield chunk
@@ -0,0 +1,86 @@
+"""Reports build time and BM25 query latency of the keyword index, offline.
+
+Chunks are drawn from a Zipf-distributed synthetic vocabulary, and every
+chunk carries one part-number-like identifier. Queries mix common words with
+such identifiers.
+
+Run from the backend directory:
+
+    python -m benchmarks.keyword_index_benchmark --chunks 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from src.keyword_index import KeywordIndex
+
+
+def make_chunks(chunks, vocab, words_per_chunk, rng):
+    """Yields synthetic chunk texts."""
+    words = np.array([f"w{i}" for i in range(vocab)])
+    for _ in range(chunks):
+        picks = np.minimum(rng.zipf(1.2, size=words_per_chunk), vocab) - 1
+        part = f"XJ-{rng.integers(0, chunks)}"
+        yield " ".join(words[picks]) + f" error {part}"
+
+
+def make_queries(queries, vocab, chunks, rng):
+    """Returns queries of two or three common words, some with an identifier."""
+    result = []
+    for i in range(queries):
+        words = [f"w{w}" for w in rng.integers(0, min(vocab, 500), size=rng.integers(2, 4))]
+        if i % 2 == 0:
+            words.append(f"XJ-{rng.integers(0, chunks)}")
+        result.append(" ".join(words))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=200000)
+    parser.add_argument("--vocab", type=int, default=50000)
+    parser.add_argument("--words", type=int, default=60)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    index = KeywordIndex()
+
+    start = time.perf_counter()
+    for i, text in enumerate(make_chunks(args.chunks, args.vocab, args.words, rng)):
+        index.add(str(i), f"doc{i // 1000}", text)
+    build_seconds = time.perf_counter() - start
+
+    queries = make_queries(args.queries, args.vocab, args.chunks, rng)
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query, args.k)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    index.remove_pdf("doc0")
+    remove_ms = (time.perf_counter() - start) * 1000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "index.npz")
+        start = time.perf_counter()
+        index.save(path)
+        save_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        KeywordIndex.load(path)
+        load_seconds = time.perf_counter() - start
+
+    print(f"chunks={args.chunks} vocab={args.vocab} words/chunk={args.words} terms={len(index.postings)}")
+    print(f"build {build_seconds:.1f} s, save {save_seconds:.1f} s, load {load_seconds:.1f} s, "
+          f"remove one PDF {remove_ms:.2f} ms")
+    print(f"query p50 {np.percentile(latencies, 50):.2f} ms, "
+          f"p95 {np.percentile(latencies, 95):.2f} ms, max {max(latencies):.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Reports retrieval latency and recall for several search configurations, offline.
+
+A synthetic, clustered corpus of random vectors is loaded into an in-memory
+ChromaDB collection. Recall@k is measured against an exact cosine top-k.
+
+Run from the backend directory:
+
+    python -m benchmarks.retrieval_benchmark --docs 20000 --dim 256
+"""
+import argparse
+import time
+
+import chromadb
+import numpy as np
+from src.retriever import DocumentRetriever, LRUCache, normalize_rows
+
+
+CONFIGS = [
+    {"search_type": "similarity", "k": 5},
+    {"search_type": "similarity", "k": 20},
+    {"search_type": "mmr", "k": 5, "fetch_k": 20, "lambda_mult": 0.5},
+    {"search_type": "mmr", "k": 8, "fetch_k": 50, "lambda_mult": 0.5},
+    {"search_type": "mmr", "k": 20, "fetch_k": 100, "lambda_mult": 0.5},
+    {"search_type": "mmr", "k": 8, "fetch_k": 50, "lambda_mult": 0.8},
+    {"search_type": "mmr", "k": 8, "fetch_k": 50, "lambda_mult": 0.5, "score_threshold": 0.8},
+]
+
+
+def make_corpus(docs, dim, clusters, rng):
+    """Generates unit vectors grouped around random cluster centers."""
+    centers = normalize_rows(rng.standard_normal((clusters, dim)))
+    labels = rng.integers(0, clusters, size=docs)
+    vectors = centers[labels] + 0.6 / np.sqrt(dim) * rng.standard_normal((docs, dim))
+    return normalize_rows(vectors).astype(np.float32)
+
+
+def load_collection(vectors):
+    """Loads the vectors into a fresh in-memory ChromaDB collection."""
+    client = chromadb.EphemeralClient()
+    try:
+        client.delete_collection("benchmark")
+    except Exception:
+        pass
+    collection = client.create_collection("benchmark", embedding_function=None)
+
+    batch_size = client.get_max_batch_size()
+    for start in range(0, len(vectors), batch_size):
+        end = min(start + batch_size, len(vectors))
+        collection.add(
+            ids=[str(i) for i in range(start, end)],
+            embeddings=vectors[start:end],
+            documents=[f"chunk {i}" for i in range(start, end)],
+            metadatas=[{"chunk_id": i} for i in range(start, end)],
+        )
+    return collection
+
+
+def run_config(collection, corpus, queries, config):
+    """Returns latency percentiles (ms), mean recall@k and mean result count of a configuration."""
+    retriever = DocumentRetriever(collection=collection, embeddings=None,
+                                  search_kwargs=config, result_cache=LRUCache(0))
+    k = config["k"]
+    latencies, recalls, counts = [], [], []
+
+    for query in queries:
+        start = time.perf_counter()
+        docs = retriever.query_candidates(query.tolist())
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        exact = set(np.argsort(-(corpus @ query))[:k].tolist())
+        found = {int(doc.id) for doc in docs}
+        recalls.append(len(found & exact) / k)
+        counts.append(len(docs))
+
+    return (np.percentile(latencies, 50), np.percentile(latencies, 95),
+            float(np.mean(recalls)), float(np.mean(counts)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--docs", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    corpus = make_corpus(args.docs, args.dim, args.clusters, rng)
+    picks = rng.integers(0, args.docs, size=args.queries)
+    queries = normalize_rows(
+        corpus[picks] + 0.3 / np.sqrt(args.dim) * rng.standard_normal((args.queries, args.dim))).astype(np.float32)
+
+    collection = load_collection(corpus)
+
+    print(f"docs={args.docs} dim={args.dim} queries={args.queries}")
+    print(f"{'config':<75} {'p50 ms':>8} {'p95 ms':>8} {'recall@k':>9} {'docs':>6}")
+    for config in CONFIGS:
+        p50, p95, recall, count = run_config(
+            collection, corpus, queries, config)
+        label = ", ".join(f"{key}={value}" for key, value in config.items())
+        print(f"{label:<75} {p50:>8.2f} {p95:>8.2f} {recall:>9.3f} {count:>6.1f}")
+
+
+if __name__ == "__main__":
+    main()
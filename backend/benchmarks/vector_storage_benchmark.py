@@ -0,0 +1,139 @@
+"""Compares memory, query latency and recall of full and truncated vector storage, offline.
+
+A synthetic, clustered corpus is generated whose variance decays over the
+dimensions, like the Matryoshka embeddings of text-embedding-3, or real
+vectors are loaded with --vectors. For every entry of --dims the vectors are
+truncated (0 keeps all), loaded into a persistent ChromaDB collection and
+searched with and without re-scoring the candidates with the full-precision
+vectors from an embedding cache. Recall@k is measured against an exact
+cosine top-k over the full vectors.
+
+Memory is reported as the size of the stored vectors, which HNSW keeps in
+RAM, and as the size of the collection on disk.
+
+Run from the backend directory:
+
+    python -m benchmarks.vector_storage_benchmark --docs 20000 --dim 3072 --dims 0 1024 256
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import chromadb
+import numpy as np
+from src.embedding_cache import EmbeddingCache, text_hash
+from src.retriever import DocumentRetriever, LRUCache, normalize_rows, truncate_rows
+
+
+def make_corpus(docs, dim, clusters, decay, rng):
+    """Generates unit vectors grouped around cluster centers, with dimension i scaled by (i + 1) ** -decay."""
+    scale = (1.0 + np.arange(dim)) ** -decay
+    centers = normalize_rows(rng.standard_normal((clusters, dim)))
+    labels = rng.integers(0, clusters, size=docs)
+    vectors = centers[labels] + 0.6 / np.sqrt(dim) * rng.standard_normal((docs, dim))
+    return normalize_rows(vectors * scale).astype(np.float32)
+
+
+def directory_size(path):
+    """Returns the total size of the files below a directory in bytes."""
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+def load_collection(path, vectors):
+    """Loads the vectors into a new persistent ChromaDB collection at path."""
+    client = chromadb.PersistentClient(path=path)
+    collection = client.create_collection("benchmark", embedding_function=None)
+
+    batch_size = client.get_max_batch_size()
+    for start in range(0, len(vectors), batch_size):
+        end = min(start + batch_size, len(vectors))
+        collection.add(
+            ids=[str(i) for i in range(start, end)],
+            embeddings=vectors[start:end],
+            documents=[f"chunk {i}" for i in range(start, end)],
+        )
+    return collection
+
+
+def load_cache(path, corpus):
+    """Stores the full-precision vectors in an embedding cache, like ingestion does."""
+    cache = EmbeddingCache(path)
+    for start in range(0, len(corpus), 1000):
+        end = min(start + 1000, len(corpus))
+        cache.put_many("benchmark", [text_hash(f"chunk {i}") for i in range(start, end)],
+                       corpus[start:end])
+    return cache
+
+
+def run_config(collection, cache, queries, exact, search_kwargs):
+    """Returns latency percentiles (ms) and mean recall@k of a configuration."""
+    retriever = DocumentRetriever(
+        collection=collection, embeddings=None, search_kwargs=search_kwargs,
+        result_cache=LRUCache(0),
+        full_vectors=lambda texts: cache.get_vectors("benchmark", texts))
+    k = search_kwargs["k"]
+    latencies, recalls = [], []
+
+    for query, truth in zip(queries, exact):
+        start = time.perf_counter()
+        docs = retriever.query_candidates(query.tolist())
+        latencies.append((time.perf_counter() - start) * 1000)
+        recalls.append(len({int(doc.id) for doc in docs} & truth) / k)
+
+    return np.percentile(latencies, 50), np.percentile(latencies, 95), float(np.mean(recalls))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--docs", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=3072)
+    parser.add_argument("--vectors", help="Use the rows of this .npy file instead of a synthetic corpus")
+    parser.add_argument("--dims", type=int, nargs="+", default=[0, 1024, 512, 256])
+    parser.add_argument("--rescore-factor", type=int, default=4)
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--decay", type=float, default=0.5)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    if args.vectors:
+        corpus = normalize_rows(np.load(args.vectors).astype(np.float32))
+    else:
+        corpus = make_corpus(args.docs, args.dim, args.clusters, args.decay, rng)
+    docs, dim = corpus.shape
+    picks = rng.integers(0, docs, size=args.queries)
+    queries = normalize_rows(
+        corpus[picks] + 0.3 / np.sqrt(dim) * rng.standard_normal((args.queries, dim))).astype(np.float32)
+    exact = [set(np.argsort(-(corpus @ query))[:args.k].tolist()) for query in queries]
+
+    work_dir = tempfile.mkdtemp(prefix="vector-storage-")
+    try:
+        cache = load_cache(os.path.join(work_dir, "cache.db"), corpus)
+
+        print(f"docs={docs} dim={dim} k={args.k} queries={args.queries}")
+        print(f"{'dims':>6} {'rescore':>8} {'vectors MB':>11} {'disk MB':>9} "
+              f"{'p50 ms':>8} {'p95 ms':>8} {'recall@k':>9}")
+        for dimensions in args.dims:
+            path = os.path.join(work_dir, f"chroma_{dimensions}")
+            vectors = truncate_rows(corpus, dimensions)
+            collection = load_collection(path, vectors)
+            vector_mb = vectors.nbytes / 2**20
+            disk_mb = directory_size(path) / 2**20
+
+            for rescore_factor in sorted({0, args.rescore_factor if dimensions else 0}):
+                p50, p95, recall = run_config(collection, cache, queries, exact, {
+                    "search_type": "similarity", "k": args.k,
+                    "dimensions": dimensions, "rescore_factor": rescore_factor})
+                print(f"{dimensions or dim:>6} {rescore_factor or '-':>8} {vector_mb:>11.1f} "
+                      f"{disk_mb:>9.1f} {p50:>8.2f} {p95:>8.2f} {recall:>9.3f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from src.embedding import get_embedding_model_name
+from src.metrics import count_cache
+from src.settings import settings
+
+
+NUMBER_PATTERN = re.compile(r"\d+")
+
+
+def normalize_question(question):
+    """Normalizes case and whitespace so trivially different questions share a cache key."""
+    return " ".join(question.lower().split())
+
+
+def question_numbers(question):
+    """Returns the numbers in a question, e.g. part numbers or values, in order."""
+    return NUMBER_PATTERN.findall(question)
+
+
+class AnswerCache:
+    """LRU/TTL cache of answers to standalone questions with an exact and a similarity tier.
+
+    Entries are scoped to the index version, models and system prompt, so an
+    answer is never served after any of them changed.
+    """
+
+    def __init__(self, max_entries, ttl_seconds, similarity_threshold):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.entries = OrderedDict()
+        self.index_version = 0
+        self.lock = threading.Lock()
+        self.matrix = None
+        self.matrix_keys = []
+        self.hits = {"exact": 0, "similar": 0}
+        self.misses = 0
+
+    def scope(self):
+        """Returns the part of the cache key that is shared by all questions."""
+        return (self.index_version, settings["MODEL"], settings["SYSTEM_PROMPT"],
+                get_embedding_model_name())
+
+    def invalidate(self):
+        """Drops all entries, e.g. after the index changed."""
+        with self.lock:
+            self.index_version += 1
+            self.entries.clear()
+            self.matrix = None
+
+    def evict_expired(self, now):
+        """Removes entries older than the TTL. Expects the lock to be held."""
+        expired = [key for key, entry in self.entries.items()
+                   if now - entry["created"] > self.ttl_seconds]
+        for key in expired:
+            del self.entries[key]
+        if expired:
+            self.matrix = None
+
+    def get_exact(self, question):
+        """Returns the cached entry for exactly this question, if any."""
+        key = (self.scope(), normalize_question(question))
+        with self.lock:
+            self.evict_expired(time.monotonic())
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            self.hits["exact"] += 1
+        count_cache("answer", hits=1)
+        return entry
+
+    def get_similar(self, question, vector):
+        """Returns the entry whose question embedding is most similar to `vector`, if close enough.
+
+        Questions that differ in a number, e.g. a part number or a value,
+        never match each other, however similar their embeddings are.
+        """
+        if vector is None:
+            return None
+        numbers = question_numbers(normalize_question(question))
+
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        scope = self.scope()
+
+        with self.lock:
+            if self.matrix is None:
+                # Only this scope, so all vectors come from the same embedding model.
+                self.matrix_keys = [key for key, entry in self.entries.items()
+                                    if entry["vector"] is not None and key[0] == scope]
+                self.matrix = (np.stack([self.entries[key]["vector"] for key in self.matrix_keys])
+                               if self.matrix_keys else np.empty((0, query.shape[0]), dtype=np.float32))
+
+            if self.matrix.shape[0] == 0 or self.matrix.shape[1] != query.shape[0]:
+                return None
+
+            scores = self.matrix @ query
+            for i in np.argsort(-scores):
+                if scores[i] < self.similarity_threshold:
+                    break
+                key = self.matrix_keys[i]
+                if key[0] == scope and key in self.entries and question_numbers(key[1]) == numbers:
+                    self.entries.move_to_end(key)
+                    self.hits["similar"] += 1
+                    count_cache("answer", hits=1)
+                    return self.entries[key]
+
+            return None
+
+    def count_miss(self):
+        """Records a lookup that found nothing in either tier."""
+        with self.lock:
+            self.misses += 1
+        count_cache("answer", misses=1)
+
+    def put(self, question, vector, answer, sources, scope):
+        """Stores the answer to a question together with its embedding.
+
+        scope is the scope() of the lookup that preceded the answer. If the
+        cache was invalidated or the settings changed since, the answer may
+        be based on the old index and is dropped.
+        """
+        if vector is not None:
+            vector = np.asarray(vector, dtype=np.float32)
+            vector /= np.linalg.norm(vector) or 1.0
+
+        key = (scope, normalize_question(question))
+        with self.lock:
+            if scope != self.scope():
+                return
+            self.entries[key] = {"answer": answer, "sources": sources,
+                                 "vector": vector, "created": time.monotonic()}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.matrix = None
+
+    def stats(self):
+        """Returns hit and miss counts and the current number of entries."""
+        return {"hits": dict(self.hits), "misses": self.misses, "entries": len(self.entries)}
+
+
+answer_cache = AnswerCache(
+    max_entries=int(settings["ANSWER_CACHE_SIZE"]),
+    ttl_seconds=float(settings["ANSWER_CACHE_TTL"]),
+    similarity_threshold=float(settings["ANSWER_CACHE_SIMILARITY"]),
+)
+
+
+async def lookup_answer(question, embeddings):
+    """Looks up a cached answer, trying the exact tier before the similarity tier.
+
+    The similarity tier is only used with ANSWER_CACHE_SIMILARITY below 1.
+    Returns (entry, vector, scope): entry is None on a miss, vector is the
+    question embedding if one was computed, so it can be reused for storing,
+    and scope has to be passed to put() with the answer.
+    """
+    scope = answer_cache.scope()
+    entry = answer_cache.get_exact(question)
+    if entry is not None:
+        return entry, None, scope
+
+    vector = None
+    if embeddings is not None and answer_cache.similarity_threshold < 1:
+        try:
+            vector = await embeddings.aembed_query(question)
+        except Exception as e:
+            print(f"Error embedding question for the answer cache: {e}")
+        entry = answer_cache.get_similar(question, vector)
+
+    if entry is None:
+        answer_cache.count_miss()
+    return entry, vector, scope
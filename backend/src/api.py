@@ -1,21 +1,47 @@
-import os
-import shutil
+import asyncio
+import json
+import time
 import uuid
+from contextlib import asynccontextmanager
 from typing import List, Optional
 from urllib.parse import unquote
 
-from fastapi import FastAPI, File, HTTPException, Query, UploadFile
+from fastapi import (BackgroundTasks, FastAPI, File, HTTPException, Query,
+                     Request, UploadFile)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from src.chat_manager import (delete_chat, get_chat_history, list_chats,
-                              save_chat_history, update_chat_title)
-from src.embedding import reset_chroma_db, store_embeddings_in_chromadb
+from starlette.concurrency import run_in_threadpool
+from src.answer_cache import answer_cache, lookup_answer
+from src.chat_manager import (append_chat_messages, delete_chat,
+                              get_chat_history, list_chats, update_chat_title)
 from src.file_manager import delete_pdf, list_pdfs, upload_pdf
-from src.preprocessing import process_all_pdfs
-from src.retrieval import chain, initialize_chain
-from src.settings import load_settings, save_settings, settings
+from src.history import load_prompt, refresh_summary
+from src.embedding import warm_up_embedding_model
+from src.ingestion import (cancel_job, enqueue_job, get_job, list_jobs,
+                           run_exclusive, start_worker, stop_worker)
+from src.metrics import render_metrics, setup_tracing, stage_seconds, timed
+from src.retrieval import get_chain, get_embeddings, initialize_chain
+from src.settings import (load_settings, reload_settings, save_settings,
+                          settings)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Loads the local embedding model, builds the shared retrieval chain and starts the ingestion worker."""
+    warm_up_embedding_model()
+    initialize_chain()
+    start_worker()
+    yield
+    await run_in_threadpool(stop_worker)
+
+
+app = FastAPI(lifespan=lifespan)
+setup_tracing(app)
+
+# Bounds the number of LLM calls in flight across all requests of this worker.
+llm_limit = int(settings["MAX_CONCURRENT_LLM_CALLS"])
+llm_semaphore = asyncio.Semaphore(llm_limit)
 
 app.add_middleware(
     CORSMiddleware,
@@ -26,58 +52,190 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def record_request_duration(request: Request, call_next):
+    """Records the duration of every request under its route, e.g. "http POST /ask/"."""
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    if route is not None:
+        stage_seconds.observe(time.perf_counter() - start,
+                              stage=f"http {request.method} {route.path}")
+    return response
+
+
 class ChatRequest(BaseModel):
     chat_id: Optional[str] = None
     question: str
     chat_history: List[dict] = []
 
 
-@app.post("/ask/")
-async def ask_ai(data: ChatRequest):
-    """Handles user queries and maintains chat history."""
-    global chain
-    chain = initialize_chain()
+def resize_llm_semaphore():
+    """Replaces the LLM semaphore if MAX_CONCURRENT_LLM_CALLS changed.
+
+    Calls already in flight finish under the old limit; new calls wait on
+    the new semaphore.
+    """
+    global llm_limit, llm_semaphore
+    limit = int(settings["MAX_CONCURRENT_LLM_CALLS"])
+    if limit != llm_limit:
+        llm_limit = limit
+        llm_semaphore = asyncio.Semaphore(limit)
+
+
+async def get_chain_or_401():
+    """Returns the shared chain or raises 401 if no API key is configured.
+
+    Building the chain opens ChromaDB and may load models, so it runs in the
+    thread pool instead of blocking the event loop.
+    """
+    chain = await run_in_threadpool(get_chain)
 
     if not chain:
         raise HTTPException(
             status_code=401, detail="Missing or invalid OpenAI API Key. Please provide a valid API key.")
 
-    chat_id = data.chat_id or str(uuid.uuid4())
-    chat_history = get_chat_history(chat_id)
+    return chain
+
+
+async def lookup_cached_answer(question, standalone):
+    """Returns (entry, question_vector, scope) from the answer cache for standalone questions.
+
+    Follow-up questions depend on the conversation, so they are never cached.
+    """
+    if not standalone or not settings["ANSWER_CACHE"]:
+        return None, None, None
+    return await lookup_answer(question, await run_in_threadpool(get_embeddings))
+
 
-    chat_history.append({"sender": "user", "text": data.question})
+def cache_answer(question, question_vector, scope, answer, sources):
+    """Stores the answer to a standalone question in the answer cache.
+
+    scope comes from lookup_cached_answer(); it is None if the question
+    must not be cached.
+    """
+    if scope is not None:
+        answer_cache.put(question, question_vector, answer, sources, scope)
+
+
+@app.post("/ask/")
+async def ask_ai(data: ChatRequest, background_tasks: BackgroundTasks):
+    """Handles user queries and maintains chat history."""
+    chain = await get_chain_or_401()
 
-    if chat_history:
-        formatted_history = "\n".join(
-            [f"{msg['sender']}: {msg['text']}" for msg in chat_history]
-        )
-        full_prompt = f"Previous conversation:\n{formatted_history}\nUser: {data.question}"
-    else:
-        full_prompt = f"User: {data.question}"
+    chat_id = data.chat_id or str(uuid.uuid4())
+    with timed("ask.history_load"):
+        context = await run_in_threadpool(load_prompt, chat_id, data.question)
+    user_message = {"sender": "user", "text": data.question}
+
+    with timed("ask.answer_cache"):
+        cached, question_vector, scope = await lookup_cached_answer(
+            data.question, context.standalone)
+    if cached is not None:
+        await run_in_threadpool(append_chat_messages, chat_id,
+                                [user_message, {"sender": "ai", "text": cached["answer"]}])
+        return {"chat_id": chat_id, "answer": cached["answer"], "cached": True}
 
     try:
-        response = chain.invoke({"input": full_prompt})
+        async with llm_semaphore:
+            with timed("ask.chain"):
+                response = await chain.ainvoke({"input": context.prompt, "query": context.query})
         answer = response["answer"]
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"AI processing error: {str(e)}")
 
-    chat_history.append({"sender": "ai", "text": answer})
-    save_chat_history(chat_id, chat_history)
+    cache_answer(data.question, question_vector, scope, answer,
+                 [doc.metadata for doc in response.get("context", [])])
+
+    with timed("ask.history_save"):
+        await run_in_threadpool(append_chat_messages, chat_id,
+                                [user_message, {"sender": "ai", "text": answer}])
+    background_tasks.add_task(
+        refresh_summary, chat_id, context.window_start_seq)
 
     return {"chat_id": chat_id, "answer": answer}
 
 
+def sse_event(event, data):
+    """Formats a server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/ask-stream/")
+async def ask_ai_stream(data: ChatRequest):
+    """Streams the answer as server-sent events.
+
+    Emits a "sources" event with the retrieved chunk metadata, then one
+    "token" event per LLM token and finally a "done" event with the full
+    answer once it has been saved to the chat history.
+    """
+    chain = await get_chain_or_401()
+
+    chat_id = data.chat_id or str(uuid.uuid4())
+    with timed("ask.history_load"):
+        context = await run_in_threadpool(load_prompt, chat_id, data.question)
+    user_message = {"sender": "user", "text": data.question}
+
+    async def cached_stream(cached):
+        yield sse_event("sources", {"chat_id": chat_id, "sources": cached["sources"]})
+        yield sse_event("token", {"text": cached["answer"]})
+        await run_in_threadpool(append_chat_messages, chat_id,
+                                [user_message, {"sender": "ai", "text": cached["answer"]}])
+        yield sse_event("done", {"chat_id": chat_id, "answer": cached["answer"], "cached": True})
+
+    async def event_stream(question_vector, scope):
+        answer_parts = []
+        sources = []
+        try:
+            async with llm_semaphore:
+                async for chunk in chain.astream({"input": context.prompt, "query": context.query}):
+                    if "context" in chunk:
+                        sources = [doc.metadata for doc in chunk["context"]]
+                        yield sse_event("sources", {"chat_id": chat_id, "sources": sources})
+                    if "answer" in chunk:
+                        answer_parts.append(chunk["answer"])
+                        yield sse_event("token", {"text": chunk["answer"]})
+        except Exception as e:
+            yield sse_event("error", {"detail": f"AI processing error: {str(e)}"})
+            return
+
+        answer = "".join(answer_parts)
+        cache_answer(data.question, question_vector, scope, answer, sources)
+        await run_in_threadpool(append_chat_messages, chat_id,
+                                [user_message, {"sender": "ai", "text": answer}])
+
+        yield sse_event("done", {"chat_id": chat_id, "answer": answer})
+
+        await refresh_summary(chat_id, context.window_start_seq)
+
+    with timed("ask.answer_cache"):
+        cached, question_vector, scope = await lookup_cached_answer(
+            data.question, context.standalone)
+    stream = cached_stream(cached) if cached is not None else event_stream(
+        question_vector, scope)
+
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/get-chats/")
 async def get_chats():
     """Lists all chats with titles."""
-    return {"chats": list_chats()}
+    return {"chats": await run_in_threadpool(list_chats)}
 
 
 @app.get("/get-chat-history/{chat_id}")
-async def get_chat_history_api(chat_id: str):
-    """Returns the history of the specified chat."""
-    history = get_chat_history(chat_id)
+async def get_chat_history_api(
+    chat_id: str,
+    limit: Optional[int] = Query(None, ge=1, description="Return only the latest N messages"),
+    before: Optional[int] = Query(None, description="Return only messages with a lower seq"),
+):
+    """Returns the history of the specified chat, optionally one page at a time."""
+    history = await run_in_threadpool(get_chat_history, chat_id, limit, before)
     if not history:
         raise HTTPException(status_code=404, detail="Chat not found")
     return {"chat_id": chat_id, "messages": history}
@@ -86,30 +244,44 @@ async def get_chat_history_api(chat_id: str):
 @app.post("/update-chat-title/{chat_id}/{new_title}")
 async def update_chat_title_api(chat_id: str, new_title: str):
     """Updates the title of a given chat."""
-    update_chat_title(chat_id, new_title)
+    await run_in_threadpool(update_chat_title, chat_id, new_title)
     return {"message": "Chat title updated successfully"}
 
 
 @app.delete("/delete-chat/{chat_id}")
 async def delete_chat_api(chat_id: str):
     """Deletes a specific chat from the database."""
-    delete_chat(chat_id)
+    await run_in_threadpool(delete_chat, chat_id)
     return {"message": f"Chat {chat_id} deleted successfully"}
 
 
+def should_ingest(ingest):
+    """Returns whether uploads should be queued for ingestion."""
+    return settings["AUTO_INGEST_UPLOADS"] if ingest is None else ingest
+
+
+def upload_result(uploaded):
+    """Formats the result of a stored upload."""
+    return {"name": uploaded["name"], "size_mb": round(uploaded["size"] / (1024 * 1024), 2),
+            "sha256": uploaded["sha256"]}
+
+
 @app.post("/upload-pdf/")
-async def upload_pdf_api(file: UploadFile = File(...)):
-    """Uploads a PDF file to the raw data directory."""
+async def upload_pdf_api(
+    file: UploadFile = File(...),
+    ingest: Optional[bool] = Query(None, description="Queue an ingestion job for the file (default: AUTO_INGEST_UPLOADS)"),
+):
+    """Streams a PDF file into the raw data directory and optionally queues its ingestion."""
     try:
-        file_size_mb = len(file.file.read()) / (1024 * 1024)
-        file.file.seek(0)
-
-        file_path = os.path.join(settings["PDF_RAW"], file.filename)
+        uploaded = await run_in_threadpool(upload_pdf, file.filename, file.file)
+        response = {"message": f"✅ {uploaded['name']} uploaded successfully!",
+                    **upload_result(uploaded)}
 
-        upload_pdf(file_path, file)
-        return {"message": f"✅ {file.filename} uploaded successfully!", "size_mb": round(file_size_mb, 2)}
+        if should_ingest(ingest):
+            response["job_id"] = await run_in_threadpool(enqueue_job, [uploaded["name"]])
+        return response
 
-    except FileExistsError as e:
+    except (FileExistsError, ValueError) as e:
         raise HTTPException(status_code=400, detail=str(e))
     except PermissionError:
         raise HTTPException(
@@ -119,10 +291,37 @@ async def upload_pdf_api(file: UploadFile = File(...)):
             status_code=500, detail=f"Unexpected error: {str(e)}")
 
 
+@app.post("/upload-pdfs/")
+async def upload_pdfs_api(
+    files: List[UploadFile] = File(...),
+    ingest: Optional[bool] = Query(None, description="Queue one ingestion job for the uploaded files (default: AUTO_INGEST_UPLOADS)"),
+):
+    """Streams several PDF files into the raw data directory.
+
+    Each file is stored independently; rejected files are reported in
+    "failed" and do not affect the others.
+    """
+    uploaded, failed = [], []
+    for file in files:
+        try:
+            uploaded.append(upload_result(await run_in_threadpool(upload_pdf, file.filename, file.file)))
+        except PermissionError:
+            failed.append({"name": file.filename,
+                           "detail": "Permission error: Check file system permissions."})
+        except Exception as e:
+            failed.append({"name": file.filename, "detail": str(e)})
+
+    response = {"uploaded": uploaded, "failed": failed}
+    if uploaded and should_ingest(ingest):
+        response["job_id"] = await run_in_threadpool(
+            enqueue_job, [item["name"] for item in uploaded])
+    return response
+
+
 @app.get("/list-pdfs/")
 async def get_list():
     """Lists all uploaded PDFs."""
-    return {"pdfs": list_pdfs()}
+    return {"pdfs": await run_in_threadpool(list_pdfs)}
 
 
 @app.delete("/delete-pdf/")
@@ -130,53 +329,66 @@ async def delete(pdf_name: str = Query(..., description="The name of the PDF fil
     """Deletes a PDF from the system, including processed data and embeddings."""
     decoded_pdf_name = unquote(pdf_name)
 
-    pdf_list = [pdf["name"] for pdf in list_pdfs()]
+    pdf_list = [pdf["name"] for pdf in await run_in_threadpool(list_pdfs)]
 
     if decoded_pdf_name not in pdf_list:
         raise HTTPException(
             status_code=404, detail=f"File '{decoded_pdf_name}' not found in the system.")
 
-    delete_pdf(decoded_pdf_name)
+    await run_in_threadpool(run_exclusive, delete_pdf, decoded_pdf_name)
+    answer_cache.invalidate()
+    await run_in_threadpool(initialize_chain, True)
     return {"message": f"File '{decoded_pdf_name}' deleted successfully!"}
 
 
 @app.post("/process-pdfs/")
-async def process_pdfs():
-    """Processes all PDFs and stores embeddings in ChromaDB."""
-    try:
-        reset_chroma_db()
+async def process_pdfs(rebuild: bool = Query(False, description="Wipe all processed data and embeddings before processing")):
+    """Queues a background job that processes new or changed PDFs and syncs their embeddings."""
+    job_id = await run_in_threadpool(enqueue_job, None, rebuild)
+    return {"message": "Ingestion job queued.", "job_id": job_id}
 
-        if os.path.exists(settings["PDF_PROCESSED"]):
-            shutil.rmtree(settings["PDF_PROCESSED"], ignore_errors=True)
-        os.makedirs(settings["PDF_PROCESSED"], exist_ok=True)
 
-        process_all_pdfs()
-        store_embeddings_in_chromadb()
+@app.get("/ingestion-jobs/")
+async def get_ingestion_jobs(limit: int = Query(20, ge=1, le=200)):
+    """Lists the most recent ingestion jobs with their progress."""
+    return {"jobs": await run_in_threadpool(list_jobs, limit)}
 
-        global chain
-        _, _, chain = initialize_chain()
 
-        return {"message": "All PDFs processed and embeddings stored successfully."}
+@app.get("/ingestion-jobs/{job_id}")
+async def get_ingestion_job(job_id: str, tasks: bool = Query(False, description="Include per-document tasks")):
+    """Returns the status, progress and throughput of an ingestion job."""
+    job = await run_in_threadpool(get_job, job_id, tasks)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.post("/ingestion-jobs/{job_id}/cancel")
+async def cancel_ingestion_job(job_id: str):
+    """Cancels a queued job or stops a running one after the current batch."""
+    job = await run_in_threadpool(cancel_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
-    except FileNotFoundError as e:
-        return {"error": f"File not found: {str(e)}"}
-    except PermissionError as e:
-        return {"error": f"Permission denied: {str(e)}"}
-    except Exception as e:
-        return {"error": f"Unexpected error: {str(e)}"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Exposes stage latencies, token counts and cache hit rates in the Prometheus text format."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/get-settings/")
 async def get_settings():
     """Returns the latest settings."""
-    return load_settings()
+    return await run_in_threadpool(load_settings)
 
 
 @app.post("/update-settings/")
 async def update_settings(updated_settings: dict):
     """Updates settings and ensures latest values are available."""
-    save_settings(updated_settings)
-    global settings
-
-    settings = load_settings()
+    await run_in_threadpool(save_settings, updated_settings)
+    await run_in_threadpool(reload_settings)
+    resize_llm_semaphore()
+    await run_in_threadpool(initialize_chain)
     return {"message": "Settings updated successfully!"}
@@ -1,81 +1,206 @@
+import ast
 import sqlite3
+import threading
+from contextlib import contextmanager
 
+from src.metrics import timed
 from src.settings import settings
 
 
 DB_PATH = settings.get("CHAT_HISTORY_PATH",
                        "data/chat_history/chat_history.db")
 
+SCHEMA_VERSION = 1
+BUSY_TIMEOUT_MS = 5000
+STATEMENT_CACHE_SIZE = 128
 
-def init_chat_db():
-    """Ensures that the SQLite chat database and required tables exist."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS chats (
-            chat_id TEXT PRIMARY KEY,
-            title TEXT,
-            messages TEXT
+_local = threading.local()
+
+
+def get_connection():
+    """Returns this thread's connection to the chat database, opening it on first use.
+
+    Connections are kept open per thread so that SQLite's prepared statement
+    cache is reused, and run in WAL mode so readers never block the writer.
+    """
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    conn = connections.get(DB_PATH)
+    if conn is None:
+        conn = sqlite3.connect(
+            DB_PATH,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        connections[DB_PATH] = conn
+    return conn
+
+
+@contextmanager
+def transaction():
+    """Runs the enclosed statements in a write transaction on this thread's connection."""
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def migrate_legacy_messages(conn):
+    """Moves conversations stored as str(list) in chats.messages into the messages table."""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(chats)")]
+    if "messages" not in columns:
+        return
+
+    rows = conn.execute(
+        "SELECT chat_id, messages FROM chats WHERE messages IS NOT NULL").fetchall()
+    for chat_id, messages in rows:
+        try:
+            history = ast.literal_eval(messages)
+        except (ValueError, SyntaxError):
+            print(f"Warning: Could not migrate messages of chat {chat_id}.")
+            continue
+
+        conn.executemany(
+            "INSERT OR IGNORE INTO messages (chat_id, seq, sender, text) VALUES (?, ?, ?, ?)",
+            [(chat_id, seq, msg.get("sender", ""), msg.get("text", ""))
+             for seq, msg in enumerate(history, start=1)]
         )
-    ''')
-    conn.commit()
-    conn.close()
 
+    conn.execute("UPDATE chats SET messages = NULL")
+    print(f"Migrated {len(rows)} chats to the messages table.")
 
-def get_chat_history(chat_id):
-    """Fetches the history of a specific chat."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT messages FROM chats WHERE chat_id = ?", (chat_id,))
-    chat = cursor.fetchone()
-    conn.close()
 
-    return eval(chat[0]) if chat else []
+def init_chat_db():
+    """Ensures that the SQLite chat database and required tables exist."""
+    with transaction() as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS chats (
+                chat_id TEXT PRIMARY KEY,
+                title TEXT
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                chat_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                sender TEXT NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (chat_id, seq)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS chat_summaries (
+                chat_id TEXT PRIMARY KEY,
+                upto_seq INTEGER NOT NULL,
+                summary TEXT NOT NULL
+            )
+        ''')
+
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            migrate_legacy_messages(conn)
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+@timed("chat_store.get_history")
+def get_chat_history(chat_id, limit=None, before_seq=None, after_seq=None):
+    """Fetches the history of a specific chat in chronological order.
+
+    With limit, only the latest `limit` messages are returned; before_seq
+    and after_seq restrict them to messages older or newer than those
+    sequence numbers, for paging through long chats.
+    """
+    query = "SELECT seq, sender, text FROM messages WHERE chat_id = ?"
+    params = [chat_id]
+
+    if before_seq is not None:
+        query += " AND seq < ?"
+        params.append(before_seq)
+    if after_seq is not None:
+        query += " AND seq > ?"
+        params.append(after_seq)
+
+    query += " ORDER BY seq DESC"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+
+    rows = get_connection().execute(query, params).fetchall()
+
+    return [{"seq": seq, "sender": sender, "text": text}
+            for seq, sender, text in reversed(rows)]
+
+
+@timed("chat_store.append_messages")
+def append_chat_messages(chat_id, messages):
+    """Appends messages to a chat, creating the chat if it does not exist yet."""
+    with transaction() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO chats (chat_id, title) VALUES (?, ?)",
+            (chat_id, f"Chat-{chat_id}")
+        )
+        last_seq = conn.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM messages WHERE chat_id = ?", (chat_id,)
+        ).fetchone()[0]
+        conn.executemany(
+            "INSERT INTO messages (chat_id, seq, sender, text) VALUES (?, ?, ?, ?)",
+            [(chat_id, last_seq + i, msg["sender"], msg["text"])
+             for i, msg in enumerate(messages, start=1)]
+        )
 
 
-def save_chat_history(chat_id, chat_history):
-    """Saves the chat history to the database."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+@timed("chat_store.get_summary")
+def get_chat_summary(chat_id):
+    """Returns (upto_seq, summary) of a chat's rolling summary, or (0, None) if there is none."""
+    row = get_connection().execute(
+        "SELECT upto_seq, summary FROM chat_summaries WHERE chat_id = ?", (chat_id,)
+    ).fetchone()
+    return row if row else (0, None)
 
-    cursor.execute(
-        "INSERT INTO chats (chat_id, title, messages) VALUES (?, ?, ?) "
-        "ON CONFLICT(chat_id) DO UPDATE SET messages = ?",
-        (chat_id, f"Chat-{chat_id}", str(chat_history), str(chat_history))
-    )
 
-    conn.commit()
-    conn.close()
+@timed("chat_store.save_summary")
+def save_chat_summary(chat_id, upto_seq, summary):
+    """Stores the rolling summary covering all messages of a chat up to upto_seq."""
+    with transaction() as conn:
+        conn.execute(
+            "INSERT INTO chat_summaries (chat_id, upto_seq, summary) VALUES (?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET upto_seq = excluded.upto_seq, summary = excluded.summary",
+            (chat_id, upto_seq, summary)
+        )
 
 
+@timed("chat_store.list_chats")
 def list_chats():
     """Lists all chats with their IDs and titles."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT chat_id, title FROM chats")
-    chats = [{"chat_id": row[0], "title": row[1] or row[0]}
-             for row in cursor.fetchall()]
-    conn.close()
-    return chats
+    rows = get_connection().execute("SELECT chat_id, title FROM chats").fetchall()
+    return [{"chat_id": row[0], "title": row[1] or row[0]} for row in rows]
 
 
+@timed("chat_store.update_title")
 def update_chat_title(chat_id, new_title):
     """Updates the title of a chat."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE chats SET title = ? WHERE chat_id = ?",
-                   (new_title, chat_id))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("UPDATE chats SET title = ? WHERE chat_id = ?",
+                     (new_title, chat_id))
 
 
+@timed("chat_store.delete_chat")
 def delete_chat(chat_id):
-    """Deletes a chat from the database."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,))
-    conn.commit()
-    conn.close()
+    """Deletes a chat and its messages from the database."""
+    with transaction() as conn:
+        conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+        conn.execute("DELETE FROM chat_summaries WHERE chat_id = ?", (chat_id,))
+        conn.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,))
 
 
 init_chat_db()
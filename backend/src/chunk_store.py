@@ -0,0 +1,100 @@
+import json
+import mmap
+import os
+
+import numpy as np
+
+
+CHUNKS_FILE = "chunks.jsonl"
+INDEX_FILE = "chunks.idx"
+METADATA_FILE = "metadata.json"
+
+
+def write_chunk_store(pdf_dir, pdf_name, chunks):
+    """Writes the chunks of a document as one JSONL file plus a byte offset index.
+
+    Each chunk is a dict with its text and, if known, the page it starts on
+    and its character span in the extracted text. metadata.json is written
+    last, so a store is only visible once it is complete.
+    """
+    os.makedirs(pdf_dir, exist_ok=True)
+    chunks_path = os.path.join(pdf_dir, CHUNKS_FILE)
+    index_path = os.path.join(pdf_dir, INDEX_FILE)
+
+    offsets = [0]
+    with open(f"{chunks_path}.tmp", "wb") as f:
+        for chunk in chunks:
+            line = (json.dumps(chunk, ensure_ascii=False) + "\n").encode("utf-8")
+            f.write(line)
+            offsets.append(offsets[-1] + len(line))
+    np.asarray(offsets, dtype="<u8").tofile(f"{index_path}.tmp")
+
+    os.replace(f"{chunks_path}.tmp", chunks_path)
+    os.replace(f"{index_path}.tmp", index_path)
+
+    metadata_path = os.path.join(pdf_dir, METADATA_FILE)
+    metadata = {"pdf_name": pdf_name, "total_chunks": len(offsets) - 1,
+                "chunks_file": CHUNKS_FILE, "index_file": INDEX_FILE}
+    with open(f"{metadata_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(metadata, f, indent=4)
+    os.replace(f"{metadata_path}.tmp", metadata_path)
+
+
+class ChunkStore:
+    """Read-only, memory-mapped view of the chunks of one document."""
+
+    def __init__(self, pdf_dir):
+        self.offsets = np.fromfile(os.path.join(
+            pdf_dir, INDEX_FILE), dtype="<u8")
+        self.file = open(os.path.join(pdf_dir, CHUNKS_FILE), "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        self.data = mmap.mmap(self.file.fileno(), 0,
+                              access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self):
+        return max(len(self.offsets) - 1, 0)
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return json.loads(self.data[self.offsets[i]:self.offsets[i + 1]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        """Unmaps and closes the chunk file."""
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_chunks(pdf_dir):
+    """Returns all chunks of a processed document as dicts, or [] if it has none.
+
+    Documents processed before the chunk store existed are read from their
+    chunk_N.txt files and only carry the text.
+    """
+    metadata_path = os.path.join(pdf_dir, METADATA_FILE)
+    if not os.path.exists(metadata_path):
+        return []
+
+    with open(metadata_path, "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+
+    if "chunk_files" in metadata:
+        chunks = []
+        for chunk_file in metadata["chunk_files"]:
+            with open(os.path.join(pdf_dir, chunk_file), "r", encoding="utf-8") as f:
+                chunks.append({"text": f.read().strip()})
+        return chunks
+
+    with ChunkStore(pdf_dir) as store:
+        return list(store)
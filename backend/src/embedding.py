@@ -1,11 +1,17 @@
 import hashlib
-import json
 import os
-import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import chromadb
 from chromadb.utils import embedding_functions
 from dotenv import load_dotenv
+from src.chunk_store import read_chunks
+from src.embedding_cache import CachedEmbeddingFunction
+from src.keyword_index import KeywordIndex
+from src.local_embedding import OnnxEmbeddingFunction, get_local_embedding_model
+from src.metrics import timed, tokens_total
+from src.retriever import truncate_rows
 from src.settings import settings
 
 
@@ -13,21 +19,147 @@ load_dotenv(override=True)
 
 PROCESSED_DIR = settings["PDF_PROCESSED"]
 CHROMA_DB_DIR = settings["CHROMA_DB_DIR"]
-COLLECTION_NAME = settings["COLLECTION_NAME"]
-EMBEDDING_MODEL = settings["EMBEDDING_MODEL"]
+KEYWORD_INDEX_PATH = settings["KEYWORD_INDEX_PATH"]
+
+# OpenAI embedding request limits: inputs per request and total tokens per request.
+MAX_EMBEDDING_BATCH_ITEMS = 2048
+MAX_EMBEDDING_BATCH_TOKENS = 300_000
+
+
+_client = None
+_client_lock = threading.Lock()
+
+_keyword_index = None
+_keyword_index_lock = threading.Lock()
+
+
+class EmbeddingModelMismatch(ValueError):
+    """Raised when the document index was built with another embedding model than the configured one."""
+
+
+def get_persistent_client():
+    """Returns the process-wide ChromaDB client, creating it on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            os.makedirs(CHROMA_DB_DIR, exist_ok=True)
+            _client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
+        return _client
 
 
 def reset_chroma_db():
-    """Resets ChromaDB by deleting and recreating the database directory."""
-    if os.path.exists(CHROMA_DB_DIR):
-        shutil.rmtree(CHROMA_DB_DIR, ignore_errors=True)
+    """Resets ChromaDB by deleting the collection and all of its embeddings.
 
-    os.makedirs(CHROMA_DB_DIR, exist_ok=True)
+    The collection is dropped through the shared client instead of removing
+    the database directory, which would break clients that are still open.
+    """
+    global _keyword_index
+    client = get_persistent_client()
+    try:
+        client.delete_collection(settings["COLLECTION_NAME"])
+    except Exception:
+        pass
 
-    client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
+    with _keyword_index_lock:
+        if _keyword_index is None:
+            _keyword_index = KeywordIndex()
+        else:
+            _keyword_index.clear()
+    save_keyword_index()
     return client
 
 
+def list_processed_pdfs():
+    """Returns the names of all PDFs with processed chunks."""
+    if not os.path.isdir(PROCESSED_DIR):
+        return []
+    return [f for f in os.listdir(PROCESSED_DIR) if os.path.isdir(os.path.join(PROCESSED_DIR, f))]
+
+
+def get_keyword_index():
+    """Returns the BM25 index of the embedded chunks, loading or rebuilding it on first use."""
+    global _keyword_index
+    with _keyword_index_lock:
+        if _keyword_index is not None:
+            return _keyword_index
+
+        if os.path.exists(KEYWORD_INDEX_PATH):
+            try:
+                _keyword_index = KeywordIndex.load(KEYWORD_INDEX_PATH)
+                return _keyword_index
+            except Exception as e:
+                print(f"Error loading keyword index, rebuilding it: {e}")
+
+        _keyword_index = build_keyword_index()
+        return _keyword_index
+
+
+def iter_stored_chunks(collection, page_size):
+    """Yields (id, document, metadata) for every chunk stored in a collection, one page at a time."""
+    offset = 0
+    while True:
+        results = collection.get(
+            include=["documents", "metadatas"], limit=page_size, offset=offset)
+        if not results["ids"]:
+            return
+        yield from zip(results["ids"], results["documents"], results["metadatas"])
+        offset += len(results["ids"])
+
+
+def build_keyword_index():
+    """Builds the keyword index from the chunks stored in ChromaDB and saves it.
+
+    Processed chunks that were never embedded, e.g. after a crash between
+    extraction and embedding, are left out, so keyword and vector search
+    always cover the same chunks.
+    """
+    index = KeywordIndex()
+    client = get_persistent_client()
+    try:
+        collection = client.get_collection(settings["COLLECTION_NAME"])
+    except Exception:
+        collection = None
+
+    if collection is not None:
+        for unique_id, chunk, metadata in iter_stored_chunks(collection, client.get_max_batch_size()):
+            index.add(unique_id, (metadata or {}).get("pdf_name"), chunk)
+    index.save(KEYWORD_INDEX_PATH)
+    return index
+
+
+def rebuild_keyword_index():
+    """Replaces the keyword index with one built from the embedded chunks, e.g. after a crash.
+
+    Retrievers keep the index they were built with, so the chain has to be
+    rebuilt afterwards.
+    """
+    global _keyword_index
+    index = build_keyword_index()
+    with _keyword_index_lock:
+        _keyword_index = index
+
+
+def save_keyword_index():
+    """Writes the keyword index to disk if it changed since it was last saved or loaded."""
+    try:
+        index = get_keyword_index()
+        if index.dirty:
+            index.save(KEYWORD_INDEX_PATH)
+    except Exception as e:
+        print(f"Error saving keyword index: {e}")
+
+
+def get_embedding_model_name():
+    """Returns the name of the configured embedding model, e.g. "text-embedding-3-large".
+
+    Local models are prefixed with "onnx:", so their vectors are never
+    mistaken for OpenAI ones.
+    """
+    if settings["EMBEDDING_BACKEND"] == "onnx":
+        return f"onnx:{settings['LOCAL_EMBEDDING_MODEL']}"
+    return settings["EMBEDDING_MODEL"]
+
+
 def get_openai_embedding_function():
     """Returns the OpenAI embedding function if API key exists, otherwise None."""
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -36,112 +168,258 @@ def get_openai_embedding_function():
         print("WARNING: No OpenAI API Key provided. Running without OpenAI embeddings.")
         return None
 
-    return embedding_functions.OpenAIEmbeddingFunction(api_key=OPENAI_API_KEY, model_name=EMBEDDING_MODEL)
+    return embedding_functions.OpenAIEmbeddingFunction(
+        api_key=OPENAI_API_KEY, model_name=settings["EMBEDDING_MODEL"])
+
+
+def get_local_embedding_function():
+    """Returns the local ONNX embedding function, or None if the model cannot be loaded."""
+    model = get_local_embedding_model()
+    if model is None:
+        return None
+    return OnnxEmbeddingFunction(model, int(settings["LOCAL_EMBEDDING_BATCH_SIZE"]))
+
+
+def warm_up_embedding_model():
+    """Loads and warms up the local embedding model if it is the configured backend."""
+    if settings["EMBEDDING_BACKEND"] == "onnx":
+        get_local_embedding_model()
+
+
+def get_embedding_function():
+    """Returns the embedding function of the configured EMBEDDING_BACKEND, or None if unavailable.
+
+    Unless EMBEDDING_CACHE is disabled, the function is wrapped in the on-disk
+    embedding cache so unchanged chunks are never embedded twice.
+    """
+    if settings["EMBEDDING_BACKEND"] == "onnx":
+        embedding_function = get_local_embedding_function()
+    else:
+        embedding_function = get_openai_embedding_function()
+
+    if embedding_function is None or not settings["EMBEDDING_CACHE"]:
+        return embedding_function
+
+    return CachedEmbeddingFunction(embedding_function, get_embedding_model_name())
+
+
+def get_embedding_dimensions():
+    """Returns the number of dimensions vectors are truncated to in ChromaDB, or 0 for all."""
+    return int(settings["EMBEDDING_DIMENSIONS"])
+
+
+def get_index_config():
+    """Returns the embedding model and dimensions the collection is expected to be built with."""
+    return get_embedding_model_name(), get_embedding_dimensions()
+
+
+def get_collection_config(collection):
+    """Returns the embedding model and dimensions the vectors of a collection were built with.
+
+    Collections from before these were recorded are assumed to hold
+    EMBEDDING_MODEL vectors of full size; empty ones are tagged with the
+    configured model and dimensions.
+    """
+    metadata = collection.metadata or {}
+    if collection.count() == 0:
+        model_name, dimensions = get_index_config()
+        if (metadata.get("embedding_model"), metadata.get("embedding_dimensions", 0)) != (model_name, dimensions):
+            collection.modify(metadata={**metadata, "embedding_model": model_name,
+                                        "embedding_dimensions": dimensions})
+        return model_name, dimensions
+
+    return (metadata.get("embedding_model", settings["EMBEDDING_MODEL"]),
+            metadata.get("embedding_dimensions", 0))
+
+
+def describe_index_config(model_name, dimensions):
+    """Returns a readable description of an embedding model and dimensions."""
+    return f"'{model_name}' ({dimensions or 'all'} dimensions)"
+
+
+def check_collection_model(collection):
+    """Raises EmbeddingModelMismatch if the collection was built with another embedding model or dimensions."""
+    built_with = get_collection_config(collection)
+    configured = get_index_config()
+    if built_with != configured:
+        raise EmbeddingModelMismatch(
+            f"The document index was built with embedding model {describe_index_config(*built_with)}, "
+            f"but {describe_index_config(*configured)} is configured. Rebuild it with "
+            f"/process-pdfs/?rebuild=true or switch back.")
 
 
 def get_chroma_client():
-    """Creates and returns ChromaDB client and collection."""
-    os.makedirs(CHROMA_DB_DIR, exist_ok=True)
-    client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
-    openai_ef = get_openai_embedding_function()
+    """Returns the shared ChromaDB client and the PDF collection.
+
+    A new collection is tagged with the configured embedding model and dimensions.
+    """
+    client = get_persistent_client()
+    model_name, dimensions = get_index_config()
 
     collection = client.get_or_create_collection(
-        name=COLLECTION_NAME,
-        embedding_function=openai_ef
+        name=settings["COLLECTION_NAME"],
+        embedding_function=None,
+        metadata={"embedding_model": model_name, "embedding_dimensions": dimensions},
     )
 
     return client, collection
 
 
-def get_existing_pdfs(collection):
-    """Fetches all PDF names that have embeddings stored in ChromaDB."""
-    try:
-        existing_data = collection.get()
-        return set(metadata["pdf_name"] for metadata in existing_data["metadatas"] if "pdf_name" in metadata)
-    except Exception as e:
-        print(f"Error fetching existing embeddings: {e}")
-        return set()
-
+def pdf_base_name(pdf_name):
+    """Returns the name a PDF is stored under in the processed directory and the metadata, without ".pdf"."""
+    return os.path.splitext(os.path.basename(pdf_name))[0]
 
-def load_text_chunks(pdf_name):
-    """Loads text chunks from the processed directory."""
-    pdf_path = os.path.join(PROCESSED_DIR, pdf_name)
-    metadata_path = os.path.join(pdf_path, "metadata.json")
 
-    if not os.path.exists(metadata_path):
-        print(f"Metadata not found for {pdf_name}. Skipping...")
-        return []
+def get_pdf_chunk_ids(collection, pdf_name, limit=None):
+    """Returns the IDs of the stored chunks of a PDF, using the metadata index instead of a full scan.
 
-    with open(metadata_path, "r", encoding="utf-8") as f:
-        metadata = json.load(f)
+    pdf_name is the name the PDF is stored under, see pdf_base_name().
+    """
+    results = collection.get(
+        where={"pdf_name": pdf_name}, limit=limit, include=[])
+    return results["ids"]
 
-    chunks = []
-    for chunk_file in metadata["chunk_files"]:
-        chunk_path = os.path.join(pdf_path, chunk_file)
-        with open(chunk_path, "r", encoding="utf-8") as f:
-            chunks.append(f.read().strip())
 
-    return chunks
+def get_existing_pdfs(collection, pdf_names):
+    """Returns the given stored PDF names that have embeddings stored in ChromaDB."""
+    existing_pdfs = set()
+    for pdf_name in pdf_names:
+        try:
+            if get_pdf_chunk_ids(collection, pdf_name, limit=1):
+                existing_pdfs.add(pdf_name)
+        except Exception as e:
+            print(f"Error checking existing embeddings for {pdf_name}: {e}")
+    return existing_pdfs
 
 
-def store_embeddings_in_chromadb():
-    """Stores text chunks as embeddings in ChromaDB, avoiding duplicates."""
-    _, collection = get_chroma_client()
+def load_chunks(pdf_name):
+    """Loads the chunks of a PDF from the processed directory."""
+    pdf_path = os.path.join(PROCESSED_DIR, pdf_name)
 
-    if collection is None:
-        print("ERROR: ChromaDB collection not found. Skipping embedding storage.")
-        return
+    if not os.path.exists(os.path.join(pdf_path, "metadata.json")):
+        print(f"Metadata not found for {pdf_name}. Skipping...")
+        return []
 
-    existing_pdfs = get_existing_pdfs(collection)
+    return read_chunks(pdf_path)
 
-    pdf_folders = [f for f in os.listdir(
-        PROCESSED_DIR) if os.path.isdir(os.path.join(PROCESSED_DIR, f))]
-    if not pdf_folders:
-        print("No processed PDFs found.")
-        return
 
-    print(f"Found {len(pdf_folders)} PDFs. Checking for new embeddings...")
+def estimate_tokens(text):
+    """Conservative token estimate used to keep embedding requests under the API token limit."""
+    return len(text) // 3 + 1
 
-    for pdf_name in pdf_folders:
-        if pdf_name in existing_pdfs:
-            print(f"Skipping {pdf_name}, already embedded.")
-            continue
 
-        chunks = load_text_chunks(pdf_name)
-        if not chunks:
-            continue
+def iter_chunk_records(pdf_names):
+    """Yields (id, document, metadata) for every processed chunk of the given PDFs.
 
-        for i, chunk in enumerate(chunks):
+    The metadata carries the page and character span of the chunk, if known,
+    so answers can cite them.
+    """
+    for pdf_name in pdf_names:
+        for i, chunk in enumerate(load_chunks(pdf_name)):
+            text = chunk["text"]
             unique_id = hashlib.md5(
-                (pdf_name + chunk[:20]).encode()).hexdigest()
-
+                f"{pdf_name}:{i+1}:{text}".encode()).hexdigest()
+            metadata = {"pdf_name": pdf_name, "chunk_id": i+1}
+            metadata.update((key, chunk[key]) for key in ("page", "start", "end")
+                            if chunk.get(key) is not None)
+            yield unique_id, text, metadata
+
+
+def batch_chunk_records(records, batch_size, max_tokens=MAX_EMBEDDING_BATCH_TOKENS):
+    """Groups chunk records into batches limited by item count and estimated tokens."""
+    batch, batch_tokens = [], 0
+    for record in records:
+        tokens = estimate_tokens(record[1])
+        if batch and (len(batch) >= batch_size or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(record)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def get_embedding_batch_size(client):
+    """Returns the configured batch size capped by the API and ChromaDB limits."""
+    return max(1, min(int(settings["EMBEDDING_BATCH_SIZE"]), MAX_EMBEDDING_BATCH_ITEMS,
+                      client.get_max_batch_size()))
+
+
+def embed_pdfs(collection, embedding_function, batch_size, pdf_names, progress=None):
+    """Embeds the processed chunks of the given PDFs and adds them to the collection.
+
+    Chunks are embedded in batches; the next batch is read and embedded in a
+    background thread while the current one is written to ChromaDB. They are
+    added to the keyword index as they are written, so it always covers the
+    same chunks as the collection; saving it is left to the caller.
+    `progress`, if given, is called with each written batch and may raise to
+    abort. With EMBEDDING_DIMENSIONS set, the stored vectors are truncated to
+    that many dimensions. Returns the number of stored chunks per PDF.
+    """
+    keyword_index = get_keyword_index()
+    for pdf_name in pdf_names:
+        keyword_index.remove_pdf(pdf_name)
+
+    batches = batch_chunk_records(iter_chunk_records(pdf_names), batch_size)
+    chunk_counts = {}
+    dimensions = get_embedding_dimensions()
+
+    def embed(batch):
+        tokens_total.inc(sum(estimate_tokens(document) for _, document, _ in batch),
+                         kind="embedding")
+        with timed("embedding.embed_batch"):
+            embeddings = embedding_function([document for _, document, _ in batch])
+        if dimensions:
+            embeddings = list(truncate_rows(embeddings, dimensions))
+        return embeddings
+
+    def write(batch, embeddings):
+        with timed("embedding.chroma_add"):
             collection.add(
-                ids=[unique_id],
-                documents=[chunk],
-                metadatas=[{"pdf_name": pdf_name, "chunk_id": i+1}],
+                ids=[unique_id for unique_id, _, _ in batch],
+                documents=[document for _, document, _ in batch],
+                embeddings=embeddings,
+                metadatas=[metadata for _, _, metadata in batch],
             )
-
-        print(f"{pdf_name}: {len(chunks)} chunks embedded and stored.")
+        for unique_id, document, metadata in batch:
+            pdf_name = metadata["pdf_name"]
+            keyword_index.add(unique_id, pdf_name, document)
+            chunk_counts[pdf_name] = chunk_counts.get(pdf_name, 0) + 1
+        if progress is not None:
+            progress(batch)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        for batch in batches:
+            future = executor.submit(embed, batch)
+            if pending is not None:
+                write(pending[0], pending[1].result())
+            pending = (batch, future)
+        if pending is not None:
+            write(pending[0], pending[1].result())
+
+    return chunk_counts
 
 
 def delete_pdf_embeddings(pdf_name):
-    """Deletes all embeddings related to a specific PDF from ChromaDB."""
-    try:
-        client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
-        collection = client.get_collection(settings["COLLECTION_NAME"])
+    """Deletes all embeddings related to a specific PDF file from ChromaDB and the keyword index.
 
-        all_embeddings = collection.get()
-        ids_to_delete = []
+    The keyword index is not saved, so deleting many PDFs costs one save at
+    the end; see save_keyword_index().
+    """
+    base_name = pdf_base_name(pdf_name)
+    delete_pdf_keywords(base_name)
 
-        normalized_pdf_name = pdf_name.replace(".pdf", "").strip().lower()
-        for doc_id, metadata in zip(all_embeddings["ids"], all_embeddings["metadatas"]):
-            meta_pdf_name = metadata.get("pdf_name", "").strip().lower()
+    try:
+        client = get_persistent_client()
+        collection = client.get_collection(settings["COLLECTION_NAME"])
 
-            if meta_pdf_name == normalized_pdf_name:
-                ids_to_delete.append(doc_id)
+        ids_to_delete = get_pdf_chunk_ids(collection, base_name)
+        batch_size = client.get_max_batch_size()
+        for start in range(0, len(ids_to_delete), batch_size):
+            collection.delete(ids=ids_to_delete[start:start + batch_size])
 
         if ids_to_delete:
-            collection.delete(ids=ids_to_delete)
             print(
                 f"Deleted {len(ids_to_delete)} embeddings related to {pdf_name}")
         else:
@@ -149,3 +427,8 @@ def delete_pdf_embeddings(pdf_name):
 
     except Exception as e:
         print(f"Error deleting embeddings for {pdf_name}: {str(e)}")
+
+
+def delete_pdf_keywords(pdf_name):
+    """Removes the chunks of a PDF, given by its stored name, from the keyword index without saving it."""
+    get_keyword_index().remove_pdf(pdf_name)
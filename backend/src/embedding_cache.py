@@ -0,0 +1,119 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction
+from src.metrics import count_cache
+from src.settings import settings
+
+
+CACHE_PATH = settings["EMBEDDING_CACHE_PATH"]
+
+# SQLite limits the number of bound parameters per statement.
+LOOKUP_BATCH_SIZE = 500
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def text_hash(text):
+    """Returns the SHA-256 hash used as cache key for a chunk text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """On-disk SQLite store of embedding vectors keyed by (model, text hash)."""
+
+    def __init__(self, path=CACHE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            ) WITHOUT ROWID
+        ''')
+        self.conn.commit()
+
+    def get_many(self, model, hashes):
+        """Returns {text_hash: vector} for every hash found in the cache."""
+        found = {}
+        unique_hashes = list(dict.fromkeys(hashes))
+        with self.lock:
+            for start in range(0, len(unique_hashes), LOOKUP_BATCH_SIZE):
+                batch = unique_hashes[start:start + LOOKUP_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    (model, *batch),
+                ).fetchall()
+                for hash_, vector in rows:
+                    found[hash_] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def get_vectors(self, model, texts):
+        """Returns the cached vector of each text, or None where it is missing."""
+        hashes = [text_hash(text) for text in texts]
+        found = self.get_many(model, hashes)
+        return [found.get(hash_) for hash_ in hashes]
+
+    def put_many(self, model, hashes, vectors):
+        """Stores vectors for the given text hashes."""
+        rows = [(model, hash_, np.asarray(vector, dtype=np.float32).tobytes())
+                for hash_, vector in zip(hashes, vectors)]
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)",
+                rows,
+            )
+            self.conn.commit()
+
+
+def get_embedding_cache():
+    """Returns the process-wide embedding cache, opening it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+        return _cache
+
+
+class CachedEmbeddingFunction(EmbeddingFunction[Documents]):
+    """Wraps a ChromaDB embedding function and only embeds texts missing from the cache."""
+
+    def __init__(self, embedding_function, model_name, cache=None):
+        self.embedding_function = embedding_function
+        self.model_name = model_name
+        self.cache = cache or get_embedding_cache()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, input: Documents):
+        hashes = [text_hash(text) for text in input]
+        cached = self.cache.get_many(self.model_name, hashes)
+
+        missing = {}
+        for text, hash_ in zip(input, hashes):
+            if hash_ not in cached and hash_ not in missing:
+                missing[hash_] = text
+
+        self.hits += len(input) - len(missing)
+        self.misses += len(missing)
+        count_cache("embedding", hits=len(input) - len(missing), misses=len(missing))
+
+        if missing:
+            vectors = self.embedding_function(list(missing.values()))
+            self.cache.put_many(self.model_name, list(missing), vectors)
+            cached.update(zip(missing, (np.asarray(vector, dtype=np.float32)
+                                        for vector in vectors)))
+
+        return [cached[hash_] for hash_ in hashes]
+
+    def stats(self):
+        """Returns the hit and miss counts of this embedding function."""
+        return {"hits": self.hits, "misses": self.misses}
@@ -0,0 +1,84 @@
+import pdfplumber
+import pypdfium2 as pdfium
+import pypdfium2.raw as pdfium_c
+from src.settings import settings
+
+
+# Pages drawing at least this many paths (ruling lines, cell borders) are
+# treated as tables and extracted with pdfplumber, which keeps their layout.
+TABLE_PATH_OBJECTS = 40
+
+
+def extract_pages_pdfplumber(file_path):
+    """Yields (page_number, text) for each non-empty page using pdfplumber's layout analysis.
+
+    Each page's layout objects are released right after extraction, so
+    memory does not grow with the page count.
+    """
+    with pdfplumber.open(file_path) as pdf:
+        for page_number, page in enumerate(pdf.pages, start=1):
+            try:
+                text = page.extract_text()
+            finally:
+                page.close()
+            if text:
+                yield page_number, text
+
+
+def is_table_page(page):
+    """Returns whether a pdfium page draws enough paths to look like a table."""
+    paths = page.get_objects(filter=[pdfium_c.FPDF_PAGEOBJ_PATH], max_depth=1)
+    return any(i + 1 >= TABLE_PATH_OBJECTS for i, _ in enumerate(paths))
+
+
+def extract_pages_pdfium(file_path, fallback=True):
+    """Yields (page_number, text) for each non-empty page using pdfium's text layer.
+
+    With `fallback`, pages where pdfium finds no text or that look like
+    tables are extracted with pdfplumber instead. The PDF is only opened
+    with pdfplumber once such a page is found.
+    """
+    pdf = pdfium.PdfDocument(file_path)
+    plumber = None
+    try:
+        for index in range(len(pdf)):
+            page = pdf[index]
+            try:
+                textpage = page.get_textpage()
+                try:
+                    text = textpage.get_text_bounded().replace("\r\n", "\n")
+                finally:
+                    textpage.close()
+                use_fallback = fallback and (not text.strip() or is_table_page(page))
+            finally:
+                page.close()
+
+            if use_fallback:
+                if plumber is None:
+                    plumber = pdfplumber.open(file_path)
+                plumber_page = plumber.pages[index]
+                try:
+                    text = plumber_page.extract_text()
+                finally:
+                    plumber_page.close()
+            if text:
+                yield index + 1, text
+    finally:
+        if plumber is not None:
+            plumber.close()
+        pdf.close()
+
+
+EXTRACTORS = {
+    "pdfium": extract_pages_pdfium,
+    "pdfplumber": extract_pages_pdfplumber,
+}
+
+
+def get_page_extractor(name=None):
+    """Returns the page extractor selected by PDF_EXTRACTOR."""
+    name = name or settings["PDF_EXTRACTOR"]
+    if name not in EXTRACTORS:
+        raise ValueError(
+            f"Unknown PDF extractor '{name}'. Available: {', '.join(EXTRACTORS)}.")
+    return EXTRACTORS[name]
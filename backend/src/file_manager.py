@@ -1,9 +1,12 @@
+import hashlib
 import json
 import os
-import shutil
+import tempfile
+import threading
 
-from src.embedding import delete_pdf_embeddings
-from src.preprocessing import delete_processed_pdf
+from src.embedding import delete_pdf_embeddings, save_keyword_index
+from src.preprocessing import (delete_processed_pdf, file_hash, is_up_to_date,
+                               load_manifest)
 from src.settings import settings
 
 
@@ -11,6 +14,11 @@ RAW_DIR = settings["PDF_RAW"]
 PROCESSED_DIR = settings["PDF_PROCESSED"]
 PROCESSED_FILES_PATH = os.path.join(RAW_DIR, "processed_files.json")
 
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+
+# Serializes the duplicate check and the rename of finished uploads.
+_upload_lock = threading.Lock()
+
 
 def ensure_directories():
     """Ensures that required directories exist."""
@@ -38,26 +46,67 @@ def load_json(filepath, default_value=None):
     return default_value if default_value is not None else []
 
 
-def upload_pdf(file_path, file_obj):
-    """Uploads a PDF file to the raw directory with validation."""
+def find_pdf_by_hash(sha256, size):
+    """Returns the name of a raw PDF with the given content, or None.
+
+    Only PDFs of the same size are compared. Their hash is taken from the
+    manifest when the file is unchanged, so most uploads hash nothing.
+    """
+    manifest = load_manifest()
+    for pdf_name in os.listdir(RAW_DIR):
+        pdf_path = os.path.join(RAW_DIR, pdf_name)
+        if not pdf_name.endswith(".pdf") or os.path.getsize(pdf_path) != size:
+            continue
+        entry = manifest.get(pdf_name)
+        known = entry["sha256"] if is_up_to_date(pdf_path, entry) else file_hash(pdf_path)
+        if known == sha256:
+            return pdf_name
+    return None
+
+
+def upload_pdf(file_name, file_obj, block_size=UPLOAD_BLOCK_SIZE):
+    """Streams an uploaded PDF into the raw directory.
+
+    The file is copied block by block into a temporary file while its size
+    and SHA-256 hash are computed, and only renamed into place once it is
+    complete and not a duplicate. Returns {"name", "size", "sha256"}.
+    """
     ensure_directories()
 
-    if not file_path.endswith(".pdf"):
+    file_name = os.path.basename(file_name)
+    if not file_name.endswith(".pdf"):
         raise ValueError("Error: Only PDF files are allowed.")
 
-    file_name = os.path.basename(file_path)
     destination_path = os.path.join(RAW_DIR, file_name)
-
     if os.path.exists(destination_path):
         raise FileExistsError(
             f"{file_name} already exists in raw directory.")
 
+    sha256 = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=RAW_DIR, prefix=".upload-", suffix=".part")
     try:
-        with open(destination_path, "wb") as buffer:
-            shutil.copyfileobj(file_obj.file, buffer)
-        print(f"Uploaded {file_name} to {RAW_DIR}")
-    except Exception as e:
-        raise RuntimeError(f"Unexpected error while copying file: {str(e)}")
+        with os.fdopen(fd, "wb") as buffer:
+            for block in iter(lambda: file_obj.read(block_size), b""):
+                sha256.update(block)
+                size += len(block)
+                buffer.write(block)
+
+        with _upload_lock:
+            if os.path.exists(destination_path):
+                raise FileExistsError(
+                    f"{file_name} already exists in raw directory.")
+            duplicate = find_pdf_by_hash(sha256.hexdigest(), size)
+            if duplicate:
+                raise FileExistsError(
+                    f"{file_name} has the same content as {duplicate}.")
+            os.replace(tmp_path, destination_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    print(f"Uploaded {file_name} to {RAW_DIR}")
+    return {"name": file_name, "size": size, "sha256": sha256.hexdigest()}
 
 
 def delete_pdf(pdf_name):
@@ -73,10 +122,11 @@ def delete_pdf(pdf_name):
     delete_processed_pdf(pdf_name)
 
     delete_pdf_embeddings(pdf_name)
+    save_keyword_index()
 
-    processed_files = load_json(PROCESSED_FILES_PATH, [])
+    processed_files = load_manifest()
     if pdf_name in processed_files:
-        processed_files.remove(pdf_name)
+        processed_files.pop(pdf_name)
         save_json(PROCESSED_FILES_PATH, processed_files)
         print(f"Deleted {pdf_name} from processed_files.json")
     else:
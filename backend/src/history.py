@@ -0,0 +1,152 @@
+from collections import namedtuple
+
+from starlette.concurrency import run_in_threadpool
+from src.chat_manager import (get_chat_history, get_chat_summary,
+                              save_chat_summary)
+from src.retrieval import get_llm
+from src.settings import settings
+from src.tokens import count_tokens
+
+
+PromptContext = namedtuple(
+    "PromptContext", ["prompt", "query", "window_start_seq", "standalone"])
+
+SUMMARY_PROMPT = (
+    "Update the running summary of a conversation between a user and an AI assistant "
+    "with the new messages below. Keep facts, names, numbers and open questions; "
+    "drop greetings and filler. Answer with the updated summary only.\n\n"
+    "Current summary:\n{summary}\n\nNew messages:\n{messages}"
+)
+
+
+def format_message(msg):
+    """Formats a chat message as a prompt line."""
+    return f"{msg['sender']}: {msg['text']}"
+
+
+def window_history(chat_history, budget):
+    """Returns the most recent messages whose formatted text fits in `budget` tokens."""
+    window = []
+    used = 0
+    for msg in reversed(chat_history):
+        used += count_tokens(format_message(msg)) + 1
+        if used > budget:
+            break
+        window.append(msg)
+    window.reverse()
+    return window
+
+
+def oldest_messages(messages, budget):
+    """Returns the oldest messages whose formatted text fits in `budget` tokens, at least one."""
+    used = 0
+    for i, msg in enumerate(messages):
+        used += count_tokens(format_message(msg)) + 1
+        if used > budget and i > 0:
+            return messages[:i]
+    return messages
+
+
+def build_prompt(chat_history, question, summary=None):
+    """Builds the chain input from the previous messages, an optional summary and the question.
+
+    Only the most recent messages that fit in HISTORY_TOKEN_BUDGET are kept;
+    the summary, if any, is charged against the same budget. Returns the
+    prompt and the messages it includes.
+    """
+    budget = int(settings["HISTORY_TOKEN_BUDGET"])
+    parts = []
+
+    if summary:
+        budget -= count_tokens(summary)
+        parts.append(f"Summary of the earlier conversation:\n{summary}")
+
+    window = window_history(chat_history, budget)
+    if window:
+        formatted_history = "\n".join(format_message(msg) for msg in window)
+        parts.append(f"Previous conversation:\n{formatted_history}")
+
+    parts.append(f"User: {question}")
+    return "\n".join(parts), window
+
+
+def build_search_query(window, question):
+    """Builds the retrieval query from the question and the previous user message, if any.
+
+    Follow-ups like "and its voltage?" only make sense together with the
+    previous question, but embedding the whole conversation adds noise.
+    """
+    for msg in reversed(window):
+        if msg["sender"] == "user":
+            return f"{msg['text']}\n{question}"
+    return question
+
+
+def load_prompt(chat_id, question):
+    """Loads a chat's recent history and summary and builds the prompt for a new question.
+
+    Returns a PromptContext with the LLM prompt, the search query, the seq of
+    the oldest message in the prompt (everything before it has to be covered
+    by the summary) and whether the question is standalone, i.e. the prompt
+    carries no earlier conversation.
+    """
+    chat_history = get_chat_history(
+        chat_id, limit=int(settings["HISTORY_MAX_MESSAGES"]))
+
+    summary = None
+    if settings["HISTORY_SUMMARY"]:
+        _, summary = get_chat_summary(chat_id)
+
+    full_prompt, window = build_prompt(chat_history, question, summary)
+
+    if window:
+        window_start_seq = window[0]["seq"]
+    elif chat_history:
+        window_start_seq = chat_history[-1]["seq"] + 1
+    else:
+        window_start_seq = 1
+
+    return PromptContext(
+        prompt=full_prompt,
+        query=build_search_query(window, question),
+        window_start_seq=window_start_seq,
+        standalone=not window and not summary,
+    )
+
+
+async def refresh_summary(chat_id, window_start_seq):
+    """Folds messages that dropped out of the prompt window into the chat's rolling summary.
+
+    The messages are folded oldest-first, in passes of at most four times
+    HISTORY_TOKEN_BUDGET tokens, and the summary is saved after each pass,
+    so a failed pass leaves the remaining messages for the next refresh.
+    """
+    if not settings["HISTORY_SUMMARY"]:
+        return
+
+    upto_seq, summary = await run_in_threadpool(get_chat_summary, chat_id)
+    if window_start_seq - 1 <= upto_seq:
+        return
+
+    llm = get_llm()
+    if llm is None:
+        return
+
+    dropped = await run_in_threadpool(
+        get_chat_history, chat_id, None, window_start_seq, upto_seq)
+    budget = 4 * int(settings["HISTORY_TOKEN_BUDGET"])
+
+    while dropped:
+        batch = oldest_messages(dropped, budget)
+        messages = "\n".join(format_message(msg) for msg in batch)
+        try:
+            response = await llm.ainvoke(
+                SUMMARY_PROMPT.format(summary=summary or "(none)", messages=messages))
+        except Exception as e:
+            print(f"Error updating summary of chat {chat_id}: {e}")
+            return
+
+        summary = response.content
+        await run_in_threadpool(save_chat_summary, chat_id,
+                                batch[-1]["seq"], summary)
+        dropped = dropped[len(batch):]
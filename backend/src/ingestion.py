@@ -0,0 +1,459 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from src.answer_cache import answer_cache
+from src.embedding import (check_collection_model, delete_pdf_embeddings,
+                           embed_pdfs, estimate_tokens, get_chroma_client,
+                           get_embedding_batch_size, get_embedding_function,
+                           get_existing_pdfs, pdf_base_name,
+                           rebuild_keyword_index, reset_chroma_db,
+                           save_keyword_index)
+from src.embedding_cache import CachedEmbeddingFunction
+from src.metrics import timed
+from src.preprocessing import (RAW_DIR, extract_chunks_parallel, list_raw_pdfs,
+                               load_manifest, prepare_pdf,
+                               remove_missing_pdfs, reset_processed_data,
+                               save_processed_pdf)
+from src.retrieval import initialize_chain
+from src.settings import settings
+
+
+DB_PATH = settings["INGESTION_DB_PATH"]
+MAX_RETRY_DELAY = 60
+BUSY_TIMEOUT_MS = 5000
+
+# The keyword index is saved at least this often (seconds) while a job runs.
+KEYWORD_INDEX_SAVE_INTERVAL = 30
+
+_local = threading.local()
+
+# Serializes document tasks with other changes to the index, e.g. deleting a PDF.
+_task_lock = threading.Lock()
+
+_wake = threading.Event()
+_stop = threading.Event()
+_worker = None
+_recover = False
+
+
+class JobCancelled(Exception):
+    """Raised inside a running job once its cancellation was requested."""
+
+
+def get_connection():
+    """Returns this thread's connection to the job database, opening it on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = sqlite3.connect(
+            DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def init_ingestion_db():
+    """Creates the job tables and requeues jobs that were interrupted by a restart."""
+    global _recover
+    conn = get_connection()
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            pdf_names TEXT,
+            rebuild INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            removed INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            cache_hits INTEGER,
+            cache_misses INTEGER,
+            created REAL NOT NULL,
+            started REAL,
+            finished REAL
+        )
+    """)
+    # Job databases from before the embedding cache counts were recorded.
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+    for column in ("cache_hits", "cache_misses"):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} INTEGER")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tasks (
+            job_id TEXT NOT NULL,
+            pdf_name TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            chunks INTEGER NOT NULL DEFAULT 0,
+            tokens INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            started REAL,
+            finished REAL,
+            PRIMARY KEY (job_id, pdf_name)
+        ) WITHOUT ROWID
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+
+    # Interrupted jobs are planned again from scratch; documents they already
+    # finished are skipped by the planning step.
+    interrupted = [row["job_id"] for row in conn.execute(
+        "SELECT job_id FROM jobs WHERE status = 'running'")]
+    for job_id in interrupted:
+        conn.execute("DELETE FROM tasks WHERE job_id = ?", (job_id,))
+        conn.execute(
+            "UPDATE jobs SET status = 'queued', started = NULL WHERE job_id = ?", (job_id,))
+    if interrupted:
+        print(f"Requeued {len(interrupted)} interrupted ingestion jobs.")
+        _recover = True
+
+
+def enqueue_job(pdf_names=None, rebuild=False):
+    """Queues an ingestion job and returns its ID.
+
+    Without pdf_names the whole raw directory is synced, including removing
+    PDFs that no longer exist; with rebuild=True all processed data and
+    embeddings are wiped first.
+    """
+    job_id = str(uuid.uuid4())
+    get_connection().execute(
+        "INSERT INTO jobs (job_id, pdf_names, rebuild, status, created) VALUES (?, ?, ?, 'queued', ?)",
+        (job_id, json.dumps(pdf_names) if pdf_names is not None else None,
+         int(rebuild), time.time()))
+    _wake.set()
+    return job_id
+
+
+def cancel_job(job_id):
+    """Cancels a queued job or asks a running one to stop. Returns the job, or None if unknown."""
+    conn = get_connection()
+    conn.execute(
+        "UPDATE jobs SET status = 'cancelled', finished = ? WHERE job_id = ? AND status = 'queued'",
+        (time.time(), job_id))
+    conn.execute(
+        "UPDATE jobs SET cancel_requested = 1 WHERE job_id = ? AND status = 'running'", (job_id,))
+    return get_job(job_id)
+
+
+def is_cancel_requested(job_id):
+    """Checks whether cancellation of a running job was requested."""
+    row = get_connection().execute(
+        "SELECT cancel_requested FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    return bool(row and row["cancel_requested"])
+
+
+def get_job(job_id, include_tasks=False):
+    """Returns the status and progress of a job, or None if it does not exist."""
+    conn = get_connection()
+    job = conn.execute("SELECT * FROM jobs WHERE job_id = ?",
+                       (job_id,)).fetchone()
+    if job is None:
+        return None
+
+    tasks = [dict(row) for row in conn.execute(
+        "SELECT * FROM tasks WHERE job_id = ? ORDER BY started IS NULL, started, pdf_name", (job_id,))]
+    counts = {}
+    for task in tasks:
+        counts[task["status"]] = counts.get(task["status"], 0) + 1
+    chunks = sum(task["chunks"] for task in tasks)
+    tokens = sum(task["tokens"] for task in tasks)
+
+    elapsed = None
+    if job["started"] is not None:
+        elapsed = (job["finished"] or time.time()) - job["started"]
+
+    def rate(value):
+        return round(value / elapsed, 2) if elapsed else None
+
+    result = {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "pdf_names": json.loads(job["pdf_names"]) if job["pdf_names"] else None,
+        "rebuild": bool(job["rebuild"]),
+        "cancel_requested": bool(job["cancel_requested"]),
+        "error": job["error"],
+        "created": job["created"],
+        "started": job["started"],
+        "finished": job["finished"],
+        "documents": {"total": len(tasks), "removed": job["removed"], **counts},
+        "chunks_done": chunks,
+        "tokens_done": tokens,
+        "elapsed_seconds": round(elapsed, 2) if elapsed is not None else None,
+        "embedding_cache": ({"hits": job["cache_hits"], "misses": job["cache_misses"]}
+                            if job["cache_hits"] is not None else None),
+        "throughput": {
+            "documents_per_second": rate(counts.get("done", 0)),
+            "chunks_per_second": rate(chunks),
+            "tokens_per_second": rate(tokens),
+        },
+    }
+    if include_tasks:
+        result["tasks"] = tasks
+    return result
+
+
+def list_jobs(limit=20):
+    """Returns the most recent jobs, newest first."""
+    rows = get_connection().execute(
+        "SELECT job_id FROM jobs ORDER BY created DESC LIMIT ?", (limit,)).fetchall()
+    return [get_job(row["job_id"]) for row in rows]
+
+
+def run_exclusive(func, *args):
+    """Runs func while no document task is in progress."""
+    with _task_lock:
+        return func(*args)
+
+
+def update_task(job_id, pdf_name, **fields):
+    """Updates columns of a task."""
+    columns = ", ".join(f"{column} = ?" for column in fields)
+    get_connection().execute(
+        f"UPDATE tasks SET {columns} WHERE job_id = ? AND pdf_name = ?",
+        (*fields.values(), job_id, pdf_name))
+
+
+def plan_job(job_id, pdf_names, collection):
+    """Finds the PDFs a job has to (re)process or embed and records them as tasks.
+
+    Returns a list of (pdf_name, fingerprint) where fingerprint is None if
+    the PDF is unchanged and only needs to be embedded.
+    """
+    manifest = load_manifest()
+    removed = []
+    if pdf_names is None:
+        pdf_names = list_raw_pdfs()
+        removed = remove_missing_pdfs(manifest, pdf_names)
+        for pdf_name in removed:
+            delete_pdf_embeddings(pdf_name)
+
+    planned = []
+    unchanged = []
+    for pdf_name in pdf_names:
+        fingerprint = prepare_pdf(pdf_name, manifest)
+        if fingerprint is not None:
+            planned.append((pdf_name, fingerprint))
+        elif pdf_name in manifest:
+            unchanged.append(pdf_name)
+
+    base_names = {pdf_base_name(pdf_name): pdf_name for pdf_name in unchanged}
+    existing = get_existing_pdfs(collection, base_names)
+    planned += [(pdf_name, None) for base_name, pdf_name in base_names.items()
+                if base_name not in existing]
+
+    conn = get_connection()
+    conn.execute("UPDATE jobs SET removed = ? WHERE job_id = ?",
+                 (len(removed), job_id))
+    conn.executemany(
+        "INSERT OR REPLACE INTO tasks (job_id, pdf_name, status) VALUES (?, ?, 'queued')",
+        [(job_id, pdf_name) for pdf_name, _ in planned])
+    return planned
+
+
+def wait_before_retry(job_id, delay):
+    """Sleeps before a retry, waking up early to honour a cancellation."""
+    deadline = time.monotonic() + delay
+    while time.monotonic() < deadline:
+        if _stop.is_set() or is_cancel_requested(job_id):
+            raise JobCancelled()
+        time.sleep(min(0.5, deadline - time.monotonic()))
+
+
+def embed_with_retries(job_id, pdf_name, collection, embedding_function, batch_size):
+    """Embeds one processed PDF, retrying failed attempts with exponential backoff.
+
+    Partially stored chunks of a failed or cancelled attempt are deleted, so
+    a PDF is either fully embedded or not at all. Returns the error of the
+    last attempt, or None on success.
+    """
+    max_retries = int(settings["INGESTION_MAX_RETRIES"])
+    retry_backoff = float(settings["INGESTION_RETRY_BACKOFF"])
+    progress = {"chunks": 0, "tokens": 0}
+
+    def report(batch):
+        progress["chunks"] += len(batch)
+        progress["tokens"] += sum(estimate_tokens(document)
+                                  for _, document, _ in batch)
+        update_task(job_id, pdf_name, **progress)
+        if _stop.is_set() or is_cancel_requested(job_id):
+            raise JobCancelled()
+
+    for attempt in range(1, max_retries + 2):
+        progress.update(chunks=0, tokens=0)
+        update_task(job_id, pdf_name, attempts=attempt, **progress)
+        try:
+            embed_pdfs(collection, embedding_function, batch_size,
+                       [pdf_base_name(pdf_name)], report)
+            return None
+        except JobCancelled:
+            delete_pdf_embeddings(pdf_name)
+            update_task(job_id, pdf_name, chunks=0, tokens=0)
+            raise
+        except Exception as e:
+            delete_pdf_embeddings(pdf_name)
+            error = f"{type(e).__name__}: {e}"
+            update_task(job_id, pdf_name, chunks=0, tokens=0, error=error)
+            print(f"Embedding {pdf_name} failed (attempt {attempt}): {error}")
+            if attempt > max_retries:
+                return error
+            wait_before_retry(job_id, min(
+                retry_backoff * 2 ** (attempt - 1), MAX_RETRY_DELAY))
+
+
+def run_task(job_id, pdf_name, fingerprint, chunks, collection, embedding_function, batch_size):
+    """Saves the extracted chunks of a PDF, if it changed, and embeds them. Returns the task status.
+
+    The embeddings of the previous version of a changed PDF are always
+    deleted, even if the new version has no text.
+    """
+    if fingerprint is not None:
+        delete_pdf_embeddings(pdf_name)
+        if not chunks:
+            update_task(job_id, pdf_name, error="No extractable text.")
+            return "skipped"
+        with timed("ingestion.save_chunks"):
+            save_processed_pdf(pdf_name, chunks, fingerprint, load_manifest())
+
+    with timed("ingestion.embed_document"):
+        error = embed_with_retries(
+            job_id, pdf_name, collection, embedding_function, batch_size)
+    return "done" if error is None else "failed"
+
+
+@timed("ingestion.job")
+def run_job(job_id, pdf_names, rebuild):
+    """Runs one job: plans its tasks, then extracts and embeds one document at a time.
+
+    Extraction runs ahead in the process pool while earlier documents are
+    being embedded. Cancellation is checked between documents and batches.
+    """
+    client, collection = get_chroma_client()
+    embedding_function = get_embedding_function()
+    if embedding_function is None:
+        raise RuntimeError(
+            "No embedding function available (no OpenAI API Key set or local model "
+            "missing). Cannot embed documents.")
+
+    with _task_lock:
+        if rebuild:
+            reset_chroma_db()
+            reset_processed_data()
+            client, collection = get_chroma_client()
+            initialize_chain(force=True)
+        check_collection_model(collection)
+        planned = plan_job(job_id, pdf_names, collection)
+
+    batch_size = get_embedding_batch_size(client)
+    pdf_paths = [os.path.join(RAW_DIR, pdf_name)
+                 for pdf_name, fingerprint in planned if fingerprint is not None]
+    extracted = extract_chunks_parallel(pdf_paths)
+    last_save = time.monotonic()
+    failed = False
+
+    try:
+        for pdf_name, fingerprint in planned:
+            if _stop.is_set() or is_cancel_requested(job_id):
+                raise JobCancelled()
+
+            with timed("ingestion.extract_wait"):
+                chunks = next(extracted) if fingerprint is not None else None
+            update_task(job_id, pdf_name, status="running",
+                        started=time.time())
+            with _task_lock:
+                status = run_task(job_id, pdf_name, fingerprint, chunks,
+                                  collection, embedding_function, batch_size)
+            update_task(job_id, pdf_name, status=status, finished=time.time())
+            failed = failed or status == "failed"
+
+            if time.monotonic() - last_save > KEYWORD_INDEX_SAVE_INTERVAL:
+                save_keyword_index()
+                last_save = time.monotonic()
+    finally:
+        extracted.close()
+        get_connection().execute(
+            "UPDATE tasks SET status = 'cancelled' WHERE job_id = ? AND status IN ('queued', 'running')",
+            (job_id,))
+        if isinstance(embedding_function, CachedEmbeddingFunction):
+            cache_stats = embedding_function.stats()
+            get_connection().execute(
+                "UPDATE jobs SET cache_hits = ?, cache_misses = ? WHERE job_id = ?",
+                (cache_stats["hits"], cache_stats["misses"], job_id))
+        save_keyword_index()
+        answer_cache.invalidate()
+        initialize_chain(force=True)
+
+    return "failed" if failed else "done"
+
+
+def claim_next_job():
+    """Marks the oldest queued job as running and returns it, or None if there is none."""
+    conn = get_connection()
+    while True:
+        job = conn.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1").fetchone()
+        if job is None:
+            return None
+        claimed = conn.execute(
+            "UPDATE jobs SET status = 'running', started = ? WHERE job_id = ? AND status = 'queued'",
+            (time.time(), job["job_id"])).rowcount
+        if claimed:
+            return job
+
+
+def worker_loop():
+    """Runs queued jobs one after another until the worker is stopped."""
+    global _recover
+    if _recover:
+        rebuild_keyword_index()
+        initialize_chain(force=True)
+        _recover = False
+
+    while not _stop.is_set():
+        job = claim_next_job()
+        if job is None:
+            _wake.wait(timeout=5)
+            _wake.clear()
+            continue
+
+        job_id = job["job_id"]
+        pdf_names = json.loads(job["pdf_names"]) if job["pdf_names"] else None
+        print(f"Starting ingestion job {job_id}.")
+        error = None
+        try:
+            status = run_job(job_id, pdf_names, bool(job["rebuild"]))
+        except JobCancelled:
+            if _stop.is_set():
+                # Interrupted by shutdown; requeued on the next start.
+                return
+            status = "cancelled"
+        except Exception as e:
+            status, error = "failed", f"{type(e).__name__}: {e}"
+            print(f"Ingestion job {job_id} failed: {error}")
+
+        get_connection().execute(
+            "UPDATE jobs SET status = ?, error = ?, finished = ? WHERE job_id = ?",
+            (status, error, time.time(), job_id))
+        print(f"Ingestion job {job_id} {status}.")
+
+
+def start_worker():
+    """Starts the background ingestion worker thread."""
+    global _worker
+    _stop.clear()
+    _worker = threading.Thread(
+        target=worker_loop, name="ingestion-worker", daemon=True)
+    _worker.start()
+
+
+def stop_worker(timeout=10):
+    """Asks the ingestion worker to stop after the current batch and waits for it."""
+    _stop.set()
+    _wake.set()
+    if _worker is not None:
+        _worker.join(timeout)
+
+
+init_ingestion_db()
@@ -0,0 +1,286 @@
+import math
+import os
+import re
+import threading
+from array import array
+from collections import Counter
+
+import numpy as np
+
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+SUBTOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have if in into is it its of on or
+that the their there these they this to was were will with what which who how
+""".split())
+
+# BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+# Terms found in more than this share of chunks carry almost no signal and
+# would dominate the cost of a query, so they are skipped if the query has
+# any more selective term.
+MAX_DF_RATIO = 0.5
+
+# Deleted chunks are only dropped from the postings once they make up this
+# share of the index.
+COMPACT_RATIO = 0.2
+
+
+def tokenize(text):
+    """Splits text into lowercase terms.
+
+    Identifiers such as part numbers or error codes ("XJ-200", "v2.1") are
+    kept as a whole and additionally split into their alphanumeric parts.
+    """
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        tokens.append(token)
+        if not token.isalnum():
+            tokens.extend(part for part in SUBTOKEN_PATTERN.findall(token)
+                          if part not in STOPWORDS)
+    return tokens
+
+
+class KeywordIndex:
+    """In-memory BM25 inverted index over the processed chunks.
+
+    Postings are append-only typed arrays, so adding a PDF only touches the
+    terms of its chunks. Removing a PDF marks its chunks as deleted; the
+    postings are compacted on save once enough chunks are deleted.
+    `dirty` tells whether there are changes since the last save or load.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Removes all chunks from the index."""
+        with self.lock:
+            self.postings = {}
+            self.chunk_ids = []
+            self.pdf_names = []
+            self.lengths = array("I")
+            self.alive = bytearray()
+            self.pdf_chunks = {}
+            self.alive_count = 0
+            self.total_length = 0
+            self.dirty = True
+
+    def add(self, chunk_id, pdf_name, text):
+        """Adds one chunk to the index."""
+        terms = tokenize(text)
+        with self.lock:
+            doc = len(self.chunk_ids)
+            self.chunk_ids.append(chunk_id)
+            self.pdf_names.append(pdf_name)
+            self.lengths.append(len(terms))
+            self.alive.append(1)
+            self.pdf_chunks.setdefault(pdf_name, []).append(doc)
+            self.alive_count += 1
+            self.total_length += len(terms)
+            self.dirty = True
+
+            for term, tf in Counter(terms).items():
+                postings = self.postings.get(term)
+                if postings is None:
+                    postings = self.postings[term] = (array("i"), array("H"))
+                postings[0].append(doc)
+                postings[1].append(min(tf, 65535))
+
+    def remove_pdf(self, pdf_name):
+        """Marks all chunks of a PDF as deleted. Returns the number of removed chunks."""
+        with self.lock:
+            docs = self.pdf_chunks.pop(pdf_name, [])
+            for doc in docs:
+                if self.alive[doc]:
+                    self.alive[doc] = 0
+                    self.alive_count -= 1
+                    self.total_length -= self.lengths[doc]
+            if docs:
+                self.dirty = True
+            return len(docs)
+
+    def __contains__(self, pdf_name):
+        return pdf_name in self.pdf_chunks
+
+    def term_weights(self, tf, lengths, idf):
+        """Returns the BM25 contribution of a term for chunks with the given tf and lengths."""
+        avg_length = self.total_length / self.alive_count
+        tf = tf.astype(np.float32)
+        norm = lengths.astype(np.float32)
+        norm *= np.float32(K1 * B / avg_length)
+        norm += np.float32(K1 * (1 - B)) + tf
+        tf *= np.float32(idf * (K1 + 1))
+        tf /= norm
+        return tf
+
+    def search(self, query, k):
+        """Returns up to k (chunk_id, score) pairs ranked by BM25.
+
+        Uses MaxScore pruning: candidates are taken from the rarest query
+        terms first, and the remaining terms are only looked up for those
+        candidates. A term only adds candidates if its upper bound could
+        still change the top k, so common terms rarely cost a full scan.
+        """
+        terms = set(tokenize(query))
+        with self.lock:
+            if not terms or self.alive_count == 0 or k <= 0:
+                return []
+
+            has_deleted = self.alive_count < len(self.chunk_ids)
+            alive = np.frombuffer(self.alive, dtype=np.bool_)
+            lengths = np.frombuffer(self.lengths, dtype=np.uint32)
+
+            matches = []
+            for term in terms:
+                postings = self.postings.get(term)
+                if postings is None:
+                    continue
+
+                docs = np.frombuffer(postings[0], dtype=np.int32)
+                tf = np.frombuffer(postings[1], dtype=np.uint16)
+                if has_deleted:
+                    live = alive[docs]
+                    docs, tf = docs[live], tf[live]
+                if len(docs):
+                    matches.append((docs, tf))
+
+            max_df = MAX_DF_RATIO * self.alive_count
+            if any(len(docs) <= max_df for docs, _ in matches):
+                matches = [match for match in matches if len(match[0]) <= max_df]
+            if not matches:
+                return []
+
+            # Postings are sorted by chunk, rarest terms first.
+            matches.sort(key=lambda match: len(match[0]))
+            idfs = [math.log(1 + (self.alive_count - len(docs) + 0.5) / (len(docs) + 0.5))
+                    for docs, _ in matches]
+            # A term never contributes more than idf * (K1 + 1).
+            bounds = np.cumsum([idf * (K1 + 1) for idf in idfs][::-1])[::-1].tolist() + [0.0]
+
+            essential = 1
+            while True:
+                candidates = matches[0][0]
+                for docs, _ in matches[1:essential]:
+                    candidates = np.union1d(candidates, docs)
+
+                scores = np.zeros(len(candidates), dtype=np.float32)
+                for i, (docs, tf) in enumerate(matches):
+                    if essential == 1 and i == 0:
+                        scores += self.term_weights(tf, lengths[docs], idfs[i])
+                    elif i < essential:
+                        positions = np.searchsorted(candidates, docs)
+                        scores[positions] += self.term_weights(
+                            tf, lengths[docs], idfs[i])
+                    else:
+                        positions = np.searchsorted(docs, candidates)
+                        np.minimum(positions, len(docs) - 1, out=positions)
+                        found = docs[positions] == candidates
+                        positions = positions[found]
+                        scores[found] += self.term_weights(
+                            tf[positions], lengths[docs[positions]], idfs[i])
+
+                if len(candidates) > k:
+                    top = np.argpartition(-scores, k - 1)[:k]
+                    threshold = scores[top].min()
+                else:
+                    top = np.arange(len(candidates))
+                    threshold = -1.0
+
+                # Chunks outside the candidates match none of the essential
+                # terms, so they score at most bounds[essential].
+                if essential == len(matches) or threshold >= bounds[essential]:
+                    break
+                essential += 1
+
+            top = top[np.argsort(-scores[top], kind="stable")]
+            return [(self.chunk_ids[candidates[i]], float(scores[i])) for i in top]
+
+    def compact(self):
+        """Rebuilds the postings without deleted chunks."""
+        with self.lock:
+            if self.alive_count == len(self.chunk_ids):
+                return
+
+            alive = np.frombuffer(self.alive, dtype=np.bool_).copy()
+            new_ids = np.cumsum(alive, dtype=np.int64) - 1
+
+            postings = {}
+            for term, (docs, tfs) in self.postings.items():
+                docs = np.frombuffer(docs, dtype=np.int32)
+                live = alive[docs]
+                if not live.any():
+                    continue
+                postings[term] = (array("i", new_ids[docs[live]].astype(np.int32).tobytes()),
+                                  array("H", np.frombuffer(tfs, dtype=np.uint16)[live].tobytes()))
+
+            keep = np.flatnonzero(alive)
+            self.postings = postings
+            self.chunk_ids = [self.chunk_ids[i] for i in keep]
+            self.pdf_names = [self.pdf_names[i] for i in keep]
+            self.lengths = array("I", np.frombuffer(
+                self.lengths, dtype=np.uint32)[keep].tobytes())
+            self.alive = bytearray(b"\x01" * len(keep))
+            self.pdf_chunks = {}
+            for doc, pdf_name in enumerate(self.pdf_names):
+                self.pdf_chunks.setdefault(pdf_name, []).append(doc)
+
+    def save(self, path):
+        """Writes the index atomically to an .npz file, compacting it first if needed."""
+        with self.lock:
+            if len(self.chunk_ids) - self.alive_count > COMPACT_RATIO * len(self.chunk_ids):
+                self.compact()
+            terms = list(self.postings)
+            offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(self.postings[term][0]) for term in terms])
+
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            tmp_path = f"{path}.tmp.npz"
+            np.savez(
+                tmp_path,
+                terms=np.array(terms, dtype=str),
+                offsets=offsets,
+                docs=np.concatenate([np.frombuffer(self.postings[term][0], dtype=np.int32)
+                                     for term in terms]) if terms else np.zeros(0, dtype=np.int32),
+                tfs=np.concatenate([np.frombuffer(self.postings[term][1], dtype=np.uint16)
+                                    for term in terms]) if terms else np.zeros(0, dtype=np.uint16),
+                chunk_ids=np.array(self.chunk_ids, dtype=str),
+                pdf_names=np.array(self.pdf_names, dtype=str),
+                lengths=np.frombuffer(self.lengths, dtype=np.uint32),
+                alive=np.frombuffer(self.alive, dtype=np.bool_),
+            )
+            os.replace(tmp_path, path)
+            self.dirty = False
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index written by save()."""
+        index = cls()
+        with np.load(path) as data:
+            offsets = data["offsets"]
+            docs = data["docs"]
+            tfs = data["tfs"]
+            for i, term in enumerate(data["terms"].tolist()):
+                start, end = offsets[i], offsets[i + 1]
+                index.postings[term] = (array("i", docs[start:end].tobytes()),
+                                        array("H", tfs[start:end].tobytes()))
+            index.chunk_ids = data["chunk_ids"].tolist()
+            index.pdf_names = data["pdf_names"].tolist()
+            index.lengths = array("I", data["lengths"].tobytes())
+            alive = data["alive"]
+
+        index.alive = bytearray(alive.tobytes())
+        index.alive_count = int(alive.sum())
+        index.total_length = int(np.frombuffer(
+            index.lengths, dtype=np.uint32)[alive].sum())
+        for doc in np.flatnonzero(alive).tolist():
+            index.pdf_chunks.setdefault(index.pdf_names[doc], []).append(doc)
+        index.dirty = False
+        return index
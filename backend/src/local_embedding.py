@@ -0,0 +1,117 @@
+import os
+import threading
+
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction
+from langchain_core.embeddings import Embeddings
+from src.metrics import timed
+from src.onnx_models import encode_inputs, load_onnx_model
+from src.settings import settings
+
+
+_model = None
+_model_key = None
+_model_lock = threading.Lock()
+
+
+class OnnxEmbeddingModel:
+    """Sentence-embedding model exported to ONNX, run on the CPU.
+
+    Expects a model that takes input_ids and attention_mask (and optionally
+    token_type_ids) and returns token embeddings, which are mean-pooled, or
+    sentence embeddings, such as all-MiniLM-L6-v2, and its Hugging Face
+    tokenizer.json. Vectors are L2-normalized.
+    """
+
+    def __init__(self, model_path, tokenizer_path, max_length=256, threads=0):
+        self.session, self.tokenizer = load_onnx_model(
+            model_path, tokenizer_path, max_length, threads)
+
+    def embed(self, texts, batch_size=32):
+        """Returns one normalized vector per text as a float32 array."""
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        # Batching texts of similar length keeps padding, and wasted compute, low.
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            for i, vector in zip(batch, self.embed_batch([texts[i] for i in batch])):
+                vectors[i] = vector
+        return np.stack(vectors)
+
+    def embed_batch(self, texts):
+        inputs, attention_mask = encode_inputs(self.session, self.tokenizer, texts)
+        output = np.asarray(self.session.run(None, inputs)[0], dtype=np.float32)
+        if output.ndim == 3:
+            mask = attention_mask[:, :, None].astype(np.float32)
+            output = (output * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        norms = np.linalg.norm(output, axis=1, keepdims=True)
+        return output / np.maximum(norms, 1e-12)
+
+
+def get_local_embedding_config():
+    """Returns the local embedding model settings; a different value requires a new model."""
+    return (
+        settings["LOCAL_EMBEDDING_MODEL"],
+        settings["LOCAL_EMBEDDING_MODEL_PATH"],
+        settings["LOCAL_EMBEDDING_TOKENIZER_PATH"],
+        int(settings["LOCAL_EMBEDDING_BATCH_SIZE"]),
+        int(settings["LOCAL_EMBEDDING_MAX_LENGTH"]),
+        int(settings["LOCAL_EMBEDDING_THREADS"]),
+    )
+
+
+def get_local_embedding_model():
+    """Returns the shared local embedding model, loading and warming it up on first use.
+
+    Returns None if the model or tokenizer cannot be loaded.
+    """
+    global _model, _model_key
+    _, model_path, tokenizer_path, _, max_length, threads = get_local_embedding_config()
+
+    key = (model_path, tokenizer_path, max_length, threads)
+    with _model_lock:
+        if _model_key != key:
+            _model_key = key
+            _model = None
+            if not os.path.exists(model_path) or not os.path.exists(tokenizer_path):
+                print(f"Warning: Local embedding model or tokenizer not found ({model_path}, "
+                      f"{tokenizer_path}).")
+            else:
+                try:
+                    with timed("embedding.local_model_load"):
+                        model = OnnxEmbeddingModel(model_path, tokenizer_path, max_length, threads)
+                        # The first runs allocate buffers and pick kernels; do
+                        # that now instead of in the first request.
+                        model.embed(["warm-up"] * 2)
+                    _model = model
+                except Exception as e:
+                    print(f"Warning: Could not load local embedding model: {e}")
+        return _model
+
+
+class OnnxEmbeddingFunction(EmbeddingFunction):
+    """ChromaDB embedding function using the local ONNX model, for ingestion."""
+
+    def __init__(self, model, batch_size=32):
+        self.model = model
+        self.batch_size = batch_size
+
+    def __call__(self, input: Documents):
+        return list(self.model.embed(list(input), self.batch_size))
+
+
+class OnnxEmbeddings(Embeddings):
+    """LangChain embeddings using the local ONNX model, for queries."""
+
+    def __init__(self, model, batch_size=32):
+        self.model = model
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts):
+        return self.model.embed(list(texts), self.batch_size).tolist()
+
+    def embed_query(self, text):
+        return self.model.embed([text])[0].tolist()
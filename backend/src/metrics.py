@@ -0,0 +1,243 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from langchain_core.callbacks import BaseCallbackHandler
+from opentelemetry import trace
+from src.settings import settings
+
+
+# Upper bounds in seconds of the stage duration histogram buckets.
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+tracer = trace.get_tracer("src")
+
+
+def format_labels(names, values):
+    """Formats label names and values as a Prometheus label set."""
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value):
+    """Formats a sample value, using Prometheus' spelling of infinity."""
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with labels."""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Histogram with labels and fixed buckets."""
+
+    def __init__(self, name, help_text, labels=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = format_labels(self.labels + ("le",), key + (format_value(bound),))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = format_labels(self.labels, key)
+                lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+stage_seconds = Histogram(
+    "rag_stage_duration_seconds", "Duration of request and ingestion stages.", ["stage"])
+tokens_total = Counter(
+    "rag_tokens_total", "Tokens sent to or generated by the models.", ["kind"])
+cache_requests_total = Counter(
+    "rag_cache_requests_total", "Cache lookups by cache and result.", ["cache", "result"])
+
+METRICS = [stage_seconds, tokens_total, cache_requests_total]
+
+
+def count_cache(cache, hits=0, misses=0):
+    """Records cache hits and misses."""
+    if hits:
+        cache_requests_total.inc(hits, cache=cache, result="hit")
+    if misses:
+        cache_requests_total.inc(misses, cache=cache, result="miss")
+
+
+@contextmanager
+def timed(stage, **attributes):
+    """Records the duration of a stage and wraps it in a tracing span.
+
+    Can also be used as a decorator of synchronous functions.
+    """
+    with tracer.start_as_current_span(stage, attributes=attributes or None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage_seconds.observe(time.perf_counter() - start, stage=stage)
+
+
+def render_metrics():
+    """Returns all metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    lines.append("# HELP rag_cache_hit_ratio Share of cache lookups that were hits.")
+    lines.append("# TYPE rag_cache_hit_ratio gauge")
+    with cache_requests_total.lock:
+        counts = dict(cache_requests_total.values)
+    for cache in sorted({cache for cache, _ in counts}):
+        hits = counts.get((cache, "hit"), 0)
+        total = hits + counts.get((cache, "miss"), 0)
+        lines.append(f'rag_cache_hit_ratio{format_labels(("cache",), (cache,))} '
+                     f"{format_value(hits / total if total else 0.0)}")
+    return "\n".join(lines) + "\n"
+
+
+class LLMMetricsCallback(BaseCallbackHandler):
+    """Records the duration, time to first token and token usage of every LLM call."""
+
+    # Run in the calling thread, so timings are not skewed by the executor
+    # and spans get the current span as their parent.
+    run_inline = True
+
+    def __init__(self):
+        self.runs = {}
+        self.lock = threading.Lock()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        span = tracer.start_span("llm")
+        with self.lock:
+            self.runs[run_id] = [time.perf_counter(), False, span]
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        with self.lock:
+            run = self.runs.get(run_id)
+            if run is None or run[1]:
+                return
+            run[1] = True
+        stage_seconds.observe(time.perf_counter() - run[0], stage="llm.first_token")
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self.finish(run_id)
+        if run is None:
+            return
+
+        input_tokens = output_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    input_tokens += usage.get("input_tokens", 0)
+                    output_tokens += usage.get("output_tokens", 0)
+        if not input_tokens and response.llm_output:
+            usage = response.llm_output.get("token_usage") or {}
+            input_tokens = usage.get("prompt_tokens", 0)
+            output_tokens = usage.get("completion_tokens", 0)
+
+        tokens_total.inc(input_tokens, kind="prompt")
+        tokens_total.inc(output_tokens, kind="completion")
+        run[2].set_attribute("llm.prompt_tokens", input_tokens)
+        run[2].set_attribute("llm.completion_tokens", output_tokens)
+        run[2].end()
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        run = self.finish(run_id)
+        if run is not None:
+            run[2].record_exception(error)
+            run[2].end()
+
+    def finish(self, run_id):
+        """Removes a run and records its duration. Returns it, or None if unknown."""
+        with self.lock:
+            run = self.runs.pop(run_id, None)
+        if run is not None:
+            stage_seconds.observe(time.perf_counter() - run[0], stage="llm")
+        return run
+
+
+llm_metrics_callback = LLMMetricsCallback()
+
+
+def setup_tracing(app=None):
+    """Exports tracing spans to the OTLP endpoint in OTEL_EXPORTER_OTLP_ENDPOINT, if set.
+
+    The OpenTelemetry SDK and exporter are only imported when tracing is
+    enabled. With an app, its requests are traced as well.
+    """
+    endpoint = settings["OTEL_EXPORTER_OTLP_ENDPOINT"]
+    if not endpoint:
+        return False
+
+    try:
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError as e:
+        print(f"Warning: OpenTelemetry SDK not available, tracing disabled: {e}")
+        return False
+
+    provider = TracerProvider(resource=Resource.create(
+        {"service.name": settings["OTEL_SERVICE_NAME"]}))
+    provider.add_span_processor(BatchSpanProcessor(
+        OTLPSpanExporter(endpoint=endpoint, insecure=endpoint.startswith("http://"))))
+    trace.set_tracer_provider(provider)
+
+    if app is not None:
+        try:
+            from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+            FastAPIInstrumentor.instrument_app(app)
+        except ImportError:
+            pass
+    print(f"Exporting traces to {endpoint}.")
+    return True
@@ -0,0 +1,40 @@
+import numpy as np
+
+
+def load_onnx_model(model_path, tokenizer_path, max_length=512, threads=0):
+    """Loads an ONNX transformer model for CPU inference and its Hugging Face tokenizer.
+
+    threads sets the number of intra-op threads; 0 lets onnxruntime use
+    every core. Returns (session, tokenizer).
+    """
+    import onnxruntime
+    from tokenizers import Tokenizer
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    if threads > 0:
+        options.intra_op_num_threads = threads
+    session = onnxruntime.InferenceSession(
+        model_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+    tokenizer = Tokenizer.from_file(tokenizer_path)
+    tokenizer.enable_truncation(max_length=max_length)
+    tokenizer.enable_padding()
+    return session, tokenizer
+
+
+def encode_inputs(session, tokenizer, items):
+    """Tokenizes texts or text pairs into the inputs the session expects.
+
+    Returns (inputs, attention_mask).
+    """
+    encodings = tokenizer.encode_batch(items)
+    attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+    inputs = {
+        "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+        "attention_mask": attention_mask,
+        "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+    }
+    input_names = {model_input.name for model_input in session.get_inputs()}
+    return {name: value for name, value in inputs.items() if name in input_names}, attention_mask
@@ -1,9 +1,18 @@
+import hashlib
 import json
+import multiprocessing
 import os
 import shutil
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
 
-import pdfplumber
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from src.chunk_store import write_chunk_store
+from src.extractors import get_page_extractor
+from src.metrics import timed
 from src.settings import settings
 
 
@@ -11,6 +20,13 @@ RAW_DIR = settings["PDF_RAW"]
 PROCESSED_DIR = settings["PDF_PROCESSED"]
 PROCESSED_FILES_PATH = os.path.join(RAW_DIR, "processed_files.json")
 
+# Pages are buffered until they hold this many chunks worth of text, then
+# split, so memory use does not depend on the size of the document.
+SPLIT_WINDOW_CHUNKS = 20
+
+# PDFs per extraction worker that may be in flight or waiting for the consumer.
+EXTRACTION_WINDOW = 2
+
 
 def load_json(filepath, default_value=None):
     """Loads a JSON file, returns default value if file does not exist."""
@@ -32,80 +48,305 @@ def save_json(filepath, data):
         print(f"Error saving JSON file {filepath}: {e}")
 
 
-def extract_text_from_pdf(file_path):
-    """Extracts text from a PDF file."""
-    try:
-        with pdfplumber.open(file_path) as pdf:
-            text = "\n".join(page.extract_text()
-                             for page in pdf.pages if page.extract_text())
-        return text if text.strip() else None
-    except Exception as e:
-        print(f"Error extracting text from {file_path}: {e}")
-        return None
+def extract_pages_from_pdf(file_path):
+    """Yields the text of each page of a PDF as (page_number, text), skipping empty pages.
+
+    Pages are read one at a time with the extractor selected by
+    PDF_EXTRACTOR, so memory does not grow with the page count.
+    """
+    yield from get_page_extractor()(file_path)
+
+
+def split_pages(pages, chunk_size=500, overlap=50):
+    """Splits extracted pages into chunks using LangChain's RecursiveCharacterTextSplitter.
 
+    Pages are joined by newlines and split incrementally: once the buffered
+    text reaches SPLIT_WINDOW_CHUNKS chunks, every chunk that ends at least
+    one chunk before the end of the buffer is final and yielded, and the
+    rest is carried over. Each chunk records the page it starts on and its
+    character span in the joined text.
+    """
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=overlap, add_start_index=True)
+    window = chunk_size * SPLIT_WINDOW_CHUNKS
+    buffer, buffer_start = "", 0
+    page_starts, page_numbers = [], []
 
-def split_text(text, chunk_size=500, overlap=50):
-    """Splits text into smaller chunks using LangChain's RecursiveCharacterTextSplitter."""
-    return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=overlap).split_text(text)
+    def split_buffer(final):
+        safe_end = len(buffer) if final else len(buffer) - chunk_size
+        chunks, carry = [], None
+        offset = 0
+        for doc in splitter.create_documents([buffer]):
+            start = max(doc.metadata["start_index"], offset)
+            offset = start
+            if start + len(doc.page_content) > safe_end:
+                carry = start
+                break
+            start += buffer_start
+            chunks.append({
+                "text": doc.page_content,
+                "page": page_numbers[bisect_right(page_starts, start) - 1],
+                "start": start,
+                "end": start + len(doc.page_content),
+            })
+        return chunks, len(buffer) if carry is None else carry
+
+    for page_number, text in pages:
+        if page_starts:
+            buffer += "\n"
+        page_starts.append(buffer_start + len(buffer))
+        page_numbers.append(page_number)
+        buffer += text
+
+        if len(buffer) >= window:
+            chunks, consumed = split_buffer(final=False)
+            yield from chunks
+            buffer, buffer_start = buffer[consumed:], buffer_start + consumed
+            # Keep only the pages that still overlap the buffer.
+            first = bisect_right(page_starts, buffer_start) - 1
+            del page_starts[:first], page_numbers[:first]
+
+    if buffer.strip():
+        yield from split_buffer(final=True)[0]
 
 
 def save_chunks(chunks, pdf_name):
-    """Saves text chunks into separate files in the processed directory."""
+    """Saves the chunks of a PDF to its chunk store in the processed directory."""
     base_filename = os.path.splitext(pdf_name)[0]
-    pdf_output_dir = os.path.join(PROCESSED_DIR, base_filename)
-    os.makedirs(pdf_output_dir, exist_ok=True)
+    write_chunk_store(os.path.join(PROCESSED_DIR, base_filename),
+                      base_filename, chunks)
+
+    print(f"Processed: {pdf_name} ({len(chunks)} chunks)")
 
-    chunk_files = []
-    for i, chunk in enumerate(chunks):
-        chunk_filename = f"chunk_{i+1}.txt"
-        chunk_path = os.path.join(pdf_output_dir, chunk_filename)
-        with open(chunk_path, "w", encoding="utf-8") as text_file:
-            text_file.write(chunk)
-        chunk_files.append(chunk_filename)
 
-    metadata = {"pdf_name": base_filename, "total_chunks": len(
-        chunks), "chunk_files": chunk_files}
-    save_json(os.path.join(pdf_output_dir, "metadata.json"), metadata)
+def file_hash(file_path, block_size=1024 * 1024):
+    """Computes the SHA-256 hash of a file without loading it fully into memory."""
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
 
-    print(f"Processed: {pdf_name} ({len(chunks)} chunks)")
 
+def load_manifest():
+    """Loads processed_files.json as {pdf_name: fingerprint}, upgrading the legacy list format."""
+    manifest = load_json(PROCESSED_FILES_PATH, {})
+    if isinstance(manifest, list):
+        return {pdf_name: {} for pdf_name in manifest}
+    return manifest
 
-def process_pdf(pdf_name):
-    """Processes a single PDF: extracts text, splits into chunks, and saves."""
-    processed_files = set(load_json(PROCESSED_FILES_PATH, []))
 
-    if pdf_name in processed_files:
-        print(f"Skipping {pdf_name}, already processed.")
+def is_up_to_date(pdf_path, entry):
+    """Checks a raw PDF against its manifest entry, hashing only when size or mtime changed."""
+    if not entry or "sha256" not in entry:
+        return False
+
+    stat = os.stat(pdf_path)
+    if entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime:
+        return True
+
+    if entry.get("size") != stat.st_size or file_hash(pdf_path) != entry["sha256"]:
+        return False
+
+    entry["mtime"] = stat.st_mtime
+    return True
+
+
+def extract_chunks(pdf_path):
+    """Extracts and splits a single PDF. Runs inside the extraction worker processes."""
+    try:
+        chunks = list(split_pages(extract_pages_from_pdf(pdf_path),
+                                  chunk_size=500, overlap=50))
+    except Exception as e:
+        print(f"Error extracting text from {pdf_path}: {e}")
+        return None
+    return chunks or None
+
+
+def get_extraction_workers():
+    """Returns the configured extraction worker count, defaulting to the CPU count."""
+    workers = int(settings["EXTRACTION_WORKERS"])
+    return workers if workers > 0 else (os.cpu_count() or 1)
+
+
+def extract_chunks_isolated(pdf_path):
+    """Extracts a single PDF in its own worker process so a crash cannot affect other PDFs."""
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        try:
+            return executor.submit(extract_chunks, pdf_path).result()
+        except BrokenProcessPool:
+            print(f"Error: Extraction worker crashed on {pdf_path}.")
+            return None
+        except Exception as e:
+            print(f"Error extracting text from {pdf_path}: {e}")
+            return None
+
+
+def extract_chunks_parallel(pdf_paths, workers=None):
+    """Extracts PDFs in a process pool and yields their chunks in input order.
+
+    At most EXTRACTION_WINDOW PDFs per worker are in flight or waiting to be
+    consumed, so memory stays bounded when the caller is slower than the
+    extraction. If a worker dies, the PDFs that were still pending are
+    retried one by one in isolated processes, so a single malformed PDF
+    only fails itself. With a single worker or PDF, each PDF gets its own
+    process; extraction never runs in the calling process, where a crash
+    of the native extractor would take down the server.
+    """
+    workers = min(workers or get_extraction_workers(), len(pdf_paths))
+    if workers <= 1:
+        for pdf_path in pdf_paths:
+            yield extract_chunks_isolated(pdf_path)
         return
 
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        remaining = iter(pdf_paths)
+        pending = deque()
+
+        def submit_more():
+            for pdf_path in islice(remaining, EXTRACTION_WINDOW * workers - len(pending)):
+                try:
+                    future = executor.submit(extract_chunks, pdf_path)
+                except BrokenProcessPool:
+                    future = None
+                pending.append((pdf_path, future))
+
+        try:
+            submit_more()
+            while pending:
+                pdf_path, future = pending.popleft()
+                try:
+                    if future is None:
+                        raise BrokenProcessPool()
+                    chunks = future.result()
+                except BrokenProcessPool:
+                    chunks = extract_chunks_isolated(pdf_path)
+                except Exception as e:
+                    print(f"Error extracting text from {pdf_path}: {e}")
+                    chunks = None
+                # Keep the workers busy while the caller handles this PDF.
+                submit_more()
+                yield chunks
+        finally:
+            # If the caller stops early, do not wait for PDFs it will never use.
+            executor.shutdown(cancel_futures=True)
+
+
+def prepare_pdf(pdf_name, manifest):
+    """Checks whether a PDF needs processing and, if so, invalidates its previous data.
+
+    Returns the new fingerprint of the PDF, or None if it can be skipped.
+    """
     pdf_path = os.path.join(RAW_DIR, pdf_name)
     if not os.path.exists(pdf_path):
         print(f"Warning: {pdf_name} not found. Skipping...")
-        return
+        return None
 
-    extracted_text = extract_text_from_pdf(pdf_path)
-    if not extracted_text:
+    if is_up_to_date(pdf_path, manifest.get(pdf_name)):
+        print(f"Skipping {pdf_name}, already processed.")
+        return None
+
+    manifest.pop(pdf_name, None)
+    delete_processed_pdf(pdf_name)
+    save_json(PROCESSED_FILES_PATH, manifest)
+
+    stat = os.stat(pdf_path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime,
+            "sha256": file_hash(pdf_path)}
+
+
+def save_processed_pdf(pdf_name, chunks, fingerprint, manifest):
+    """Saves the chunks of a processed PDF and records it in the manifest."""
+    if not chunks:
         print(f"Warning: No extractable text in {pdf_name}. Skipping...")
         return
 
-    chunks = split_text(extracted_text, chunk_size=500, overlap=50)
     save_chunks(chunks, pdf_name)
 
-    processed_files.add(pdf_name)
-    save_json(PROCESSED_FILES_PATH, list(processed_files))
+    manifest[pdf_name] = fingerprint
+    save_json(PROCESSED_FILES_PATH, manifest)
+
+
+def process_pdf(pdf_name, manifest=None):
+    """Processes a single PDF: extracts text, splits into chunks, and saves.
 
+    Returns True if the PDF was (re)processed, meaning any embeddings stored
+    for it are outdated.
+    """
+    if manifest is None:
+        manifest = load_manifest()
 
-def process_all_pdfs():
-    """Processes all PDFs in the raw directory."""
-    pdf_files = [f for f in os.listdir(RAW_DIR) if f.endswith(".pdf")]
+    fingerprint = prepare_pdf(pdf_name, manifest)
+    if fingerprint is None:
+        return False
+
+    with timed("preprocessing.extract"):
+        chunks = extract_chunks_isolated(os.path.join(RAW_DIR, pdf_name))
+    with timed("preprocessing.save"):
+        save_processed_pdf(pdf_name, chunks, fingerprint, manifest)
+    return True
+
+
+def list_raw_pdfs():
+    """Returns the names of all PDFs in the raw directory."""
+    return [f for f in os.listdir(RAW_DIR) if f.endswith(".pdf")]
+
+
+def remove_missing_pdfs(manifest, pdf_files):
+    """Deletes the processed data of PDFs that are in the manifest but no longer in `pdf_files`.
+
+    Returns their names.
+    """
+    removed = [pdf_name for pdf_name in manifest if pdf_name not in pdf_files]
+    for pdf_name in removed:
+        manifest.pop(pdf_name)
+        delete_processed_pdf(pdf_name)
+    if removed:
+        save_json(PROCESSED_FILES_PATH, manifest)
+    return removed
+
+
+@timed("preprocessing.process_all")
+def process_all_pdfs(workers=None):
+    """Incrementally processes the raw directory.
+
+    Only new or changed PDFs are re-extracted, in parallel worker processes,
+    and processed data of PDFs that no longer exist is removed. Returns the
+    names of PDFs whose embeddings are outdated ("updated") or orphaned
+    ("removed").
+    """
+    manifest = load_manifest()
+    pdf_files = list_raw_pdfs()
+    removed = remove_missing_pdfs(manifest, pdf_files)
 
     if not pdf_files:
         print("No PDFs found in the raw directory.")
-        return
+        return {"updated": [], "removed": removed}
 
     print(f"Found {len(pdf_files)} PDFs. Processing...")
+    pending = []
     for pdf_file in pdf_files:
-        process_pdf(pdf_file)
+        fingerprint = prepare_pdf(pdf_file, manifest)
+        if fingerprint is not None:
+            pending.append((pdf_file, fingerprint))
+
+    pdf_paths = [os.path.join(RAW_DIR, pdf_name) for pdf_name, _ in pending]
+    for (pdf_name, fingerprint), chunks in zip(pending, extract_chunks_parallel(pdf_paths, workers)):
+        save_processed_pdf(pdf_name, chunks, fingerprint, manifest)
+
+    return {"updated": [pdf_name for pdf_name, _ in pending], "removed": removed}
+
+
+def reset_processed_data():
+    """Deletes all processed chunks and the manifest so every PDF is processed again."""
+    if os.path.exists(PROCESSED_DIR):
+        shutil.rmtree(PROCESSED_DIR, ignore_errors=True)
+    os.makedirs(PROCESSED_DIR, exist_ok=True)
+
+    if os.path.exists(PROCESSED_FILES_PATH):
+        os.remove(PROCESSED_FILES_PATH)
 
 
 def delete_processed_pdf(pdf_name):
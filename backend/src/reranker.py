@@ -0,0 +1,107 @@
+import os
+import threading
+
+import numpy as np
+from src.metrics import timed
+from src.onnx_models import encode_inputs, load_onnx_model
+from src.settings import settings
+from src.tokens import count_tokens
+
+
+_reranker = None
+_reranker_key = None
+_reranker_lock = threading.Lock()
+
+
+class CrossEncoderReranker:
+    """Scores query-chunk pairs with a cross-encoder exported to ONNX, on the CPU.
+
+    Expects a model that takes input_ids and attention_mask (and optionally
+    token_type_ids) and returns one relevance logit per pair, such as
+    ms-marco-MiniLM-L-6-v2, and its Hugging Face tokenizer.json.
+    """
+
+    def __init__(self, model_path, tokenizer_path, max_length=512, threads=0):
+        self.session, self.tokenizer = load_onnx_model(
+            model_path, tokenizer_path, max_length, threads)
+
+    def score(self, query, texts, batch_size=16):
+        """Returns the relevance score of each text for the query."""
+        scores = []
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            inputs, _ = encode_inputs(self.session, self.tokenizer,
+                                      [(query, text) for text in batch])
+            logits = self.session.run(None, inputs)[0]
+            scores.append(np.asarray(logits, dtype=np.float32).reshape(len(batch), -1)[:, 0])
+        return np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32)
+
+
+def get_rerank_config():
+    """Returns the reranking settings; a different value requires a new chain."""
+    return (
+        bool(settings["RERANKER"]),
+        settings["RERANKER_MODEL_PATH"],
+        settings["RERANKER_TOKENIZER_PATH"],
+        int(settings["RERANKER_TOP_N"]),
+        int(settings["RERANKER_TOKEN_BUDGET"]),
+        int(settings["RERANKER_BATCH_SIZE"]),
+        int(settings["RERANKER_MAX_LENGTH"]),
+        int(settings["RERANKER_THREADS"]),
+    )
+
+
+def get_reranker():
+    """Returns the shared reranker, loading it on first use.
+
+    Returns None if reranking is disabled or the model cannot be loaded.
+    """
+    global _reranker, _reranker_key
+    enabled, model_path, tokenizer_path, _, _, _, max_length, threads = get_rerank_config()
+    if not enabled:
+        return None
+
+    key = (model_path, tokenizer_path, max_length, threads)
+    with _reranker_lock:
+        if _reranker_key != key:
+            _reranker_key = key
+            _reranker = None
+            if not os.path.exists(model_path) or not os.path.exists(tokenizer_path):
+                print(f"Warning: Reranker model or tokenizer not found ({model_path}, "
+                      f"{tokenizer_path}). Reranking disabled.")
+            else:
+                try:
+                    _reranker = CrossEncoderReranker(model_path, tokenizer_path, max_length, threads)
+                except Exception as e:
+                    print(f"Warning: Could not load reranker: {e}. Reranking disabled.")
+        return _reranker
+
+
+def select_within_budget(docs, top_n, token_budget):
+    """Returns the first top_n documents whose text fits in token_budget; always at least one."""
+    selected = []
+    used = 0
+    for doc in docs[:top_n]:
+        tokens = count_tokens(doc.page_content)
+        if selected and used + tokens > token_budget:
+            break
+        selected.append(doc)
+        used += tokens
+    return selected
+
+
+def rerank_documents(reranker, query, docs):
+    """Orders the documents by cross-encoder score and keeps the top-n within the token budget."""
+    _, _, _, top_n, token_budget, batch_size, _, _ = get_rerank_config()
+    if not docs:
+        return docs
+
+    with timed("retrieval.rerank"):
+        scores = reranker.score(query, [doc.page_content for doc in docs], batch_size)
+    order = np.argsort(-scores, kind="stable")
+    ranked = []
+    for i in order:
+        doc = docs[i]
+        doc.metadata = {**doc.metadata, "rerank_score": float(scores[i])}
+        ranked.append(doc)
+    return select_within_budget(ranked, top_n, token_budget)
@@ -1,18 +1,31 @@
 import os
+import threading
+from collections import namedtuple
 
 from dotenv import load_dotenv
-from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_chroma import Chroma
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from src.embedding import get_chroma_client
+from src.embedding import (EmbeddingModelMismatch, check_collection_model,
+                           get_embedding_model_name, get_index_config,
+                           get_keyword_index, get_persistent_client)
+from src.embedding_cache import get_embedding_cache
+from src.local_embedding import (OnnxEmbeddings, get_local_embedding_config,
+                                 get_local_embedding_model)
+from src.metrics import llm_metrics_callback
+from src.reranker import get_rerank_config, get_reranker, rerank_documents
+from src.retriever import CachedQueryEmbeddings, DocumentRetriever, LRUCache
 from src.settings import settings
 
 load_dotenv(override=True)
 
-current_api_key = os.getenv("OPENAI_API_KEY", "")
-chain = None
+ChainState = namedtuple("ChainState", ["config", "chain", "llm", "embeddings"])
+
+# The active chain and its clients. The state is only ever replaced as a
+# whole, so readers never see a chain that does not match its configuration.
+_active = ChainState(None, None, None, None)
+_build_lock = threading.Lock()
 
 STATIC_PROMPT = (
     "You are an AI assistant. You must answer user questions strictly based on the provided document context. "
@@ -23,44 +36,103 @@ STATIC_PROMPT = (
 )
 
 
-def initialize_chain():
-    """Initializes the AI model and retriever only if an API key is set."""
-    global chain, current_api_key
-
-    api_key = os.getenv("OPENAI_API_KEY", "")
-
-    if not api_key:
-        print("Warning: No OpenAI API Key set. Model initialization skipped.")
-        chain = None
-        return None
-
-    if chain is not None and api_key == current_api_key:
-        return chain
-
-    current_api_key = api_key
-
-    embedding_model = OpenAIEmbeddings(
-        model=settings["EMBEDDING_MODEL"],
-        openai_api_key=api_key
+def get_chain_config():
+    """Returns the settings a chain is built from; a different value requires a new chain."""
+    return (
+        os.getenv("OPENAI_API_KEY", ""),
+        settings["MODEL"],
+        settings["SYSTEM_PROMPT"],
+        settings["EMBEDDING_BACKEND"],
+        settings["EMBEDDING_MODEL"],
+        get_local_embedding_config(),
+        settings["COLLECTION_NAME"],
+        tuple(sorted(get_search_kwargs().items())),
+        get_rerank_config(),
     )
 
-    client, _ = get_chroma_client()
 
-    vector_db = Chroma(
-        client=client,
-        collection_name=settings["COLLECTION_NAME"],
-        embedding_function=embedding_model
+def build_llm(api_key):
+    """Builds the chat model client used by the chain."""
+    return ChatOpenAI(
+        model=settings["MODEL"],
+        api_key=api_key,
+        temperature=0.3,
+        stream_usage=True,
+        callbacks=[llm_metrics_callback],
     )
 
-    retriever = vector_db.as_retriever(
-        search_type="mmr",
-        search_kwargs={"k": 20, "fetch_k": 100}
-    )
 
-    llm = ChatOpenAI(
-        model=settings["MODEL"],
-        api_key=api_key,
-        temperature=0.3
+def build_embeddings(api_key):
+    """Builds the query embedding client used by the retriever.
+
+    With EMBEDDING_BACKEND "onnx" queries are embedded by the local model;
+    returns None if it cannot be loaded.
+    """
+    if settings["EMBEDDING_BACKEND"] == "onnx":
+        model = get_local_embedding_model()
+        if model is None:
+            return None
+        embedding_model = OnnxEmbeddings(model, int(settings["LOCAL_EMBEDDING_BATCH_SIZE"]))
+    else:
+        embedding_model = OpenAIEmbeddings(
+            model=settings["EMBEDDING_MODEL"],
+            openai_api_key=api_key
+        )
+    return CachedQueryEmbeddings(embedding_model, get_embedding_model_name())
+
+
+def get_search_kwargs():
+    """Returns the retrieval parameters configured in settings.json.
+
+    With reranking enabled, RERANKER_CANDIDATES chunks are retrieved and the
+    reranker picks the ones passed to the LLM. With EMBEDDING_DIMENSIONS set,
+    RESCORE_FACTOR times as many candidates are re-scored with the
+    full-precision vectors from the embedding cache.
+    """
+    k = int(settings["RETRIEVAL_K"])
+    if settings["RERANKER"]:
+        k = max(k, int(settings["RERANKER_CANDIDATES"]))
+    return {
+        "search_type": settings["RETRIEVAL_SEARCH_TYPE"],
+        "k": k,
+        "fetch_k": max(int(settings["RETRIEVAL_FETCH_K"]), k),
+        "lambda_mult": float(settings["RETRIEVAL_LAMBDA"]),
+        "score_threshold": float(settings["RETRIEVAL_SCORE_THRESHOLD"]),
+        "hybrid": bool(settings["HYBRID_SEARCH"]),
+        "keyword_k": int(settings["KEYWORD_K"]),
+        "rrf_k": float(settings["RRF_K"]),
+        "dimensions": int(settings["EMBEDDING_DIMENSIONS"]),
+        "rescore_factor": int(settings["RESCORE_FACTOR"]) if settings["EMBEDDING_CACHE"] else 0,
+    }
+
+
+def build_chain(llm, embedding_model):
+    """Builds the retrieval chain on top of the shared vector store.
+
+    The chain takes the LLM prompt as "input" and the standalone search
+    query as "query", so the conversation history is never embedded. If the
+    collection was built with another embedding model, every retrieval fails
+    with EmbeddingModelMismatch instead of returning unrelated chunks.
+    """
+    model_name, dimensions = get_index_config()
+    collection = get_persistent_client().get_or_create_collection(
+        name=settings["COLLECTION_NAME"], embedding_function=None,
+        metadata={"embedding_model": model_name, "embedding_dimensions": dimensions})
+    try:
+        check_collection_model(collection)
+        mismatch = None
+    except EmbeddingModelMismatch as e:
+        print(f"Warning: {e}")
+        mismatch = str(e)
+
+    retriever = DocumentRetriever(
+        collection=collection,
+        embeddings=embedding_model,
+        search_kwargs=get_search_kwargs(),
+        result_cache=LRUCache(int(settings["RETRIEVER_CACHE_SIZE"]), name="retriever_result"),
+        keyword_index=get_keyword_index() if settings["HYBRID_SEARCH"] else None,
+        full_vectors=(lambda texts: get_embedding_cache().get_vectors(model_name, texts))
+        if dimensions and settings["EMBEDDING_CACHE"] else None,
     )
 
     prompt = ChatPromptTemplate.from_messages([
@@ -70,6 +142,73 @@ def initialize_chain():
     ])
 
     question_answer_chain = create_stuff_documents_chain(llm, prompt)
-    chain = create_retrieval_chain(retriever, question_answer_chain)
+    retrieve_documents = (RunnableLambda(lambda x: x["query"]) | retriever).with_config(
+        run_name="retrieve_documents")
+
+    if mismatch is not None:
+        def refuse(_):
+            raise EmbeddingModelMismatch(mismatch)
+        retrieve_documents = RunnableLambda(refuse).with_config(run_name="retrieve_documents")
+
+    reranker = get_reranker()
+    if reranker is not None and mismatch is None:
+        retrieve_documents = (
+            RunnablePassthrough.assign(documents=retrieve_documents)
+            | RunnableLambda(lambda x: rerank_documents(reranker, x["query"], x["documents"]))
+        ).with_config(run_name="rerank_documents")
+
+    return RunnablePassthrough.assign(context=retrieve_documents).assign(
+        answer=question_answer_chain)
+
+
+def initialize_chain(force=False):
+    """Builds the shared chain if the configuration changed and returns it.
+
+    Returns None if no OpenAI API Key is set. With force=True the chain is
+    rebuilt even if the configuration is unchanged, e.g. after the index changed.
+    """
+    global _active
+
+    with _build_lock:
+        config = get_chain_config()
+
+        if not force and _active.chain is not None and config == _active.config:
+            return _active.chain
+
+        api_key = config[0]
+        if not api_key:
+            print("Warning: No OpenAI API Key set. Model initialization skipped.")
+            _active = ChainState(config, None, None, None)
+            return None
+
+        llm = build_llm(api_key)
+        embeddings = build_embeddings(api_key)
+        if embeddings is None:
+            print("Warning: No embedding model available. Model initialization skipped.")
+            _active = ChainState(config, None, None, None)
+            return None
+        chain = build_chain(llm, embeddings)
+        _active = ChainState(config, chain, llm, embeddings)
+        return chain
+
+
+def get_chain():
+    """Returns the shared chain without rebuilding it, building it only if none exists yet."""
+    chain = _active.chain
+    if chain is not None:
+        return chain
+    return initialize_chain()
 
-    return chain
+
+def get_llm():
+    """Returns the chat model of the shared chain, or None if no chain is available."""
+    if get_chain() is None:
+        return None
+    return _active.llm
+
+
+def get_embeddings():
+    """Returns the query embedding client of the shared chain, or None if no chain is available."""
+    if get_chain() is None:
+        return None
+    return _active.embeddings
@@ -0,0 +1,294 @@
+import asyncio
+import contextvars
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from src.metrics import count_cache, timed
+from src.settings import settings
+
+
+class LRUCache:
+    """Small thread-safe least-recently-used mapping.
+
+    With a name, hits and misses are also reported to the metrics.
+    """
+
+    def __init__(self, max_entries, name=None):
+        self.max_entries = max_entries
+        self.name = name
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the cached value or None, marking the key as recently used."""
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        if self.name:
+            count_cache(self.name, hits=int(value is not None), misses=int(value is None))
+        return value
+
+    def put(self, key, value):
+        """Stores a value, evicting the least recently used entry if full."""
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        """Returns hit and miss counts and the current number of entries."""
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+
+# Shared by every chain built in this process, so it survives chain rebuilds.
+query_embedding_cache = LRUCache(
+    int(settings["QUERY_EMBEDDING_CACHE_SIZE"]), name="query_embedding")
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """Embeddings wrapper that keeps query embeddings in an in-process LRU cache."""
+
+    def __init__(self, embeddings, model_name):
+        self.embeddings = embeddings
+        self.model_name = model_name
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        key = (self.model_name, text)
+        vector = query_embedding_cache.get(key)
+        if vector is None:
+            with timed("retrieval.query_embedding"):
+                vector = self.embeddings.embed_query(text)
+            query_embedding_cache.put(key, vector)
+        return vector
+
+    async def aembed_query(self, text):
+        key = (self.model_name, text)
+        vector = query_embedding_cache.get(key)
+        if vector is None:
+            with timed("retrieval.query_embedding"):
+                vector = await self.embeddings.aembed_query(text)
+            query_embedding_cache.put(key, vector)
+        return vector
+
+
+def maximal_marginal_relevance(query_similarities, vectors, k, lambda_mult):
+    """Selects k rows of `vectors` by maximal marginal relevance.
+
+    Expects L2-normalized vectors and their precomputed cosine similarity to
+    the query. Each step is a single matrix-vector product, so the cost is
+    O(k * n * d) without building the full n x n similarity matrix.
+    Returns the selected row indices in selection order.
+    """
+    n = len(query_similarities)
+    k = min(k, n)
+    if k <= 0:
+        return []
+
+    selected = [int(np.argmax(query_similarities))]
+    max_redundancy = vectors @ vectors[selected[0]]
+    available = np.ones(n, dtype=bool)
+    available[selected[0]] = False
+
+    while len(selected) < k:
+        scores = lambda_mult * query_similarities - \
+            (1 - lambda_mult) * max_redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_redundancy, vectors @ vectors[best], out=max_redundancy)
+
+    return selected
+
+
+def reciprocal_rank_fusion(rankings, rrf_k):
+    """Merges several ranked ID lists by reciprocal-rank fusion.
+
+    Each ID scores sum(1 / (rrf_k + rank)) over the lists it appears in, so
+    no score normalization between the rankers is needed. Returns the IDs
+    ordered by fused score.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def normalize_rows(vectors):
+    """Returns the rows of a matrix scaled to unit length."""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def truncate_rows(vectors, dimensions):
+    """Keeps the first `dimensions` columns of a matrix and rescales the rows to unit length.
+
+    Matryoshka-trained models such as text-embedding-3 front-load the
+    information in their vectors, so the truncated ones stay usable for
+    search. With dimensions 0 the vectors are only normalized.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dimensions:
+        vectors = vectors[:, :dimensions]
+    return normalize_rows(vectors)
+
+
+class DocumentRetriever(BaseRetriever):
+    """Retriever over the Chroma collection that caches the document IDs of each search.
+
+    search_kwargs holds search_type ("mmr" or "similarity"), k, fetch_k,
+    lambda_mult and score_threshold, a minimum cosine similarity to the query.
+    MMR re-ranks the fetched candidates with their stored vectors in NumPy.
+    If the collection holds vectors truncated to `dimensions`, queries are
+    truncated alike; with full_vectors, a function returning the
+    full-precision vector (or None) of each text, rescore_factor times as
+    many candidates are fetched and re-scored with the full vectors.
+    With hybrid set and a keyword_index, the top keyword_k BM25 hits are
+    fused with the vector results by reciprocal-rank fusion (rrf_k).
+    The result cache lives on the retriever, so rebuilding the chain after an
+    index change also drops all cached results.
+    """
+
+    collection: Any
+    embeddings: Any
+    search_kwargs: dict
+    result_cache: Any
+    keyword_index: Any = None
+    full_vectors: Any = None
+
+    def result_key(self, query, vector):
+        """Returns the result cache key of a query, its vector and the search parameters."""
+        digest = hashlib.sha1(np.asarray(
+            vector, dtype=np.float32).tobytes())
+        digest.update(query.encode())
+        return (digest.hexdigest(), *sorted(self.search_kwargs.items()))
+
+    def load_documents(self, ids):
+        """Loads documents by ID. Returns a dict of the ones that exist."""
+        results = self.collection.get(
+            ids=list(ids), include=["documents", "metadatas"])
+        return {doc_id: Document(page_content=text, metadata=metadata or {}, id=doc_id)
+                for doc_id, text, metadata in zip(results["ids"], results["documents"], results["metadatas"])}
+
+    def get_documents(self, ids):
+        """Loads documents by ID, in the given order. Returns None if any is missing."""
+        docs = self.load_documents(ids)
+        if len(docs) != len(ids):
+            return None
+        return [docs[doc_id] for doc_id in ids]
+
+    def fuse_keyword_hits(self, query, docs):
+        """Fuses the vector results with the BM25 hits of the query. Returns at most k documents."""
+        k = int(self.search_kwargs.get("k", 4))
+        keyword_k = int(self.search_kwargs.get("keyword_k", 20))
+        rrf_k = float(self.search_kwargs.get("rrf_k", 60))
+
+        with timed("retrieval.keyword_search"):
+            hits = [chunk_id for chunk_id, _ in self.keyword_index.search(query, keyword_k)]
+        if not hits:
+            return docs
+
+        ranked = reciprocal_rank_fusion([[doc.id for doc in docs], hits], rrf_k)[:k]
+        known = {doc.id: doc for doc in docs}
+        missing = [doc_id for doc_id in ranked if doc_id not in known]
+        if missing:
+            known.update(self.load_documents(missing))
+        return [known[doc_id] for doc_id in ranked if doc_id in known]
+
+    def query_candidates(self, vector):
+        """Fetches the nearest candidates and ranks them according to search_kwargs."""
+        search_type = self.search_kwargs.get("search_type", "mmr")
+        k = int(self.search_kwargs.get("k", 4))
+        fetch_k = int(self.search_kwargs.get("fetch_k", 20))
+        n_results = max(fetch_k if search_type == "mmr" else k, k)
+        dimensions = int(self.search_kwargs.get("dimensions", 0))
+        rescore_factor = int(self.search_kwargs.get("rescore_factor", 0))
+        rescore = bool(dimensions) and self.full_vectors is not None and rescore_factor > 1
+
+        count = self.collection.count()
+        if count == 0:
+            return []
+
+        query = truncate_rows([vector], dimensions)[0]
+        with timed("retrieval.chroma_query"):
+            results = self.collection.query(
+                query_embeddings=[query],
+                n_results=min(n_results * rescore_factor if rescore else n_results, count),
+                include=["documents", "metadatas", "embeddings"],
+            )
+        ids = results["ids"][0]
+        if not ids:
+            return []
+
+        vectors = None
+        if rescore:
+            with timed("retrieval.rescore"):
+                full = self.full_vectors(results["documents"][0])
+                if all(v is not None for v in full):
+                    vectors = truncate_rows(full, 0)
+                    query = truncate_rows([vector], 0)[0]
+        if vectors is None:
+            vectors = truncate_rows(results["embeddings"][0], 0)
+        similarities = vectors @ query
+
+        candidates = np.argsort(-similarities, kind="stable")[:n_results]
+        score_threshold = self.search_kwargs.get("score_threshold")
+        if score_threshold:
+            candidates = candidates[similarities[candidates] >= float(score_threshold)]
+
+        if search_type == "mmr":
+            lambda_mult = float(self.search_kwargs.get("lambda_mult", 0.5))
+            with timed("retrieval.mmr"):
+                picked = maximal_marginal_relevance(
+                    similarities[candidates], vectors[candidates], k, lambda_mult)
+            order = candidates[picked]
+        else:
+            order = candidates[:k]
+
+        return [Document(page_content=results["documents"][0][i],
+                         metadata=results["metadatas"][0][i] or {}, id=ids[i])
+                for i in order]
+
+    @timed("retrieval.search")
+    def search(self, query, vector):
+        """Returns the documents for a query and its vector, reusing cached IDs when possible."""
+        key = self.result_key(query, vector)
+        ids = self.result_cache.get(key)
+        if ids is not None:
+            docs = self.get_documents(ids)
+            if docs is not None:
+                return docs
+
+        docs = self.query_candidates(vector)
+        if self.keyword_index is not None and self.search_kwargs.get("hybrid"):
+            docs = self.fuse_keyword_hits(query, docs)
+        self.result_cache.put(key, [doc.id for doc in docs])
+        return docs
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        return self.search(query, self.embeddings.embed_query(query))
+
+    async def _aget_relevant_documents(self, query, *, run_manager):
+        vector = await self.embeddings.aembed_query(query)
+        # Copy the context, so the search span is a child of the request's span.
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            None, context.run, self.search, query, vector)
@@ -19,7 +19,55 @@ DEFAULT_SETTINGS = {
     "CHROMA_DB_DIR": "data/chroma_db",
     "COLLECTION_NAME": "pdf_embeddings",
     "EMBEDDING_MODEL": "text-embedding-3-large",
-    "CHAT_HISTORY_PATH": "data/chat_history/chat_history.db"
+    "EMBEDDING_BACKEND": "openai",
+    "EMBEDDING_DIMENSIONS": 0,
+    "RESCORE_FACTOR": 4,
+    "LOCAL_EMBEDDING_MODEL": "all-MiniLM-L6-v2",
+    "LOCAL_EMBEDDING_MODEL_PATH": "models/embedding/model.onnx",
+    "LOCAL_EMBEDDING_TOKENIZER_PATH": "models/embedding/tokenizer.json",
+    "LOCAL_EMBEDDING_BATCH_SIZE": 32,
+    "LOCAL_EMBEDDING_MAX_LENGTH": 256,
+    "LOCAL_EMBEDDING_THREADS": 0,
+    "CHAT_HISTORY_PATH": "data/chat_history/chat_history.db",
+    "EMBEDDING_BATCH_SIZE": 256,
+    "EXTRACTION_WORKERS": 0,
+    "PDF_EXTRACTOR": "pdfium",
+    "EMBEDDING_CACHE": True,
+    "EMBEDDING_CACHE_PATH": "data/embedding_cache/embeddings.db",
+    "MAX_CONCURRENT_LLM_CALLS": 16,
+    "HISTORY_TOKEN_BUDGET": 2000,
+    "HISTORY_MAX_MESSAGES": 50,
+    "HISTORY_SUMMARY": False,
+    "ANSWER_CACHE": True,
+    "ANSWER_CACHE_SIZE": 1000,
+    "ANSWER_CACHE_TTL": 86400,
+    "ANSWER_CACHE_SIMILARITY": 1.0,
+    "QUERY_EMBEDDING_CACHE_SIZE": 1024,
+    "RETRIEVER_CACHE_SIZE": 1024,
+    "RETRIEVAL_SEARCH_TYPE": "mmr",
+    "RETRIEVAL_K": 8,
+    "RETRIEVAL_FETCH_K": 50,
+    "RETRIEVAL_LAMBDA": 0.5,
+    "RETRIEVAL_SCORE_THRESHOLD": 0.0,
+    "HYBRID_SEARCH": True,
+    "KEYWORD_K": 20,
+    "RRF_K": 60,
+    "RERANKER": False,
+    "RERANKER_MODEL_PATH": "models/reranker/model.onnx",
+    "RERANKER_TOKENIZER_PATH": "models/reranker/tokenizer.json",
+    "RERANKER_CANDIDATES": 20,
+    "RERANKER_TOP_N": 5,
+    "RERANKER_TOKEN_BUDGET": 2000,
+    "RERANKER_BATCH_SIZE": 16,
+    "RERANKER_MAX_LENGTH": 512,
+    "RERANKER_THREADS": 0,
+    "KEYWORD_INDEX_PATH": "data/keyword_index/index.npz",
+    "INGESTION_DB_PATH": "data/ingestion/jobs.db",
+    "INGESTION_MAX_RETRIES": 3,
+    "INGESTION_RETRY_BACKOFF": 2.0,
+    "AUTO_INGEST_UPLOADS": True,
+    "OTEL_EXPORTER_OTLP_ENDPOINT": "",
+    "OTEL_SERVICE_NAME": "pdf-chat-backend"
 }
 
 
@@ -31,12 +79,18 @@ def ensure_directories():
     os.makedirs(DEFAULT_SETTINGS["CHROMA_DB_DIR"], exist_ok=True)
     os.makedirs(os.path.dirname(
         DEFAULT_SETTINGS["CHAT_HISTORY_PATH"]), exist_ok=True)
+    os.makedirs(os.path.dirname(
+        DEFAULT_SETTINGS["EMBEDDING_CACHE_PATH"]), exist_ok=True)
+    os.makedirs(os.path.dirname(
+        DEFAULT_SETTINGS["KEYWORD_INDEX_PATH"]), exist_ok=True)
+    os.makedirs(os.path.dirname(
+        DEFAULT_SETTINGS["INGESTION_DB_PATH"]), exist_ok=True)
 
 
 def load_settings():
     """Loads the latest configuration from settings.json and .env dynamically."""
     ensure_directories()
-    settings = {}
+    settings = dict(DEFAULT_SETTINGS)
 
     if not os.path.exists(SETTINGS_FILE):
         with open(SETTINGS_FILE, "w", encoding="utf-8") as file:
@@ -56,10 +110,14 @@ def load_settings():
 
 
 def save_settings(new_settings):
-    """Saves settings to settings.json, excluding API Key."""
+    """Saves settings to settings.json, excluding API Key. Keys not given keep their stored value."""
     env_vars = {}
     json_settings = {}
 
+    if os.path.exists(SETTINGS_FILE):
+        with open(SETTINGS_FILE, "r", encoding="utf-8") as file:
+            json_settings.update(json.load(file))
+
     for key, value in new_settings.items():
         if key == "OPENAI_API_KEY":
             env_vars["OPENAI_API_KEY"] = value.strip()
@@ -74,4 +132,10 @@ def save_settings(new_settings):
         load_dotenv(override=True)
 
 
+def reload_settings():
+    """Reloads settings in place so that every module importing them sees the new values."""
+    settings.update(load_settings())
+    return settings
+
+
 settings = load_settings()
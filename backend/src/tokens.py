@@ -0,0 +1,25 @@
+from functools import lru_cache
+
+import tiktoken
+from src.settings import settings
+
+
+@lru_cache(maxsize=8)
+def get_encoding(model):
+    """Returns the tiktoken encoding of a model, or None if it cannot be loaded (e.g. offline)."""
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"Warning: Could not load tiktoken encoding for {model}: {e}")
+        return None
+
+
+def count_tokens(text):
+    """Counts the tokens of a text for the configured model."""
+    encoding = get_encoding(settings["MODEL"])
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
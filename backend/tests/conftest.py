@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# The application creates its settings and data directories relative to the
+# working directory on import, so the tests run in a scratch directory.
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.chdir(tempfile.mkdtemp(prefix="pdf-chat-tests-"))
+os.environ.pop("OPENAI_API_KEY", None)
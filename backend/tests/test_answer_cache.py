@@ -0,0 +1,19 @@
+from src.answer_cache import AnswerCache
+
+
+def test_answer_from_before_an_invalidation_is_dropped():
+    cache = AnswerCache(max_entries=10, ttl_seconds=60, similarity_threshold=1.0)
+    scope = cache.scope()
+    cache.invalidate()
+
+    cache.put("What is E12?", None, "old answer", [], scope)
+
+    assert cache.get_exact("What is E12?") is None
+
+
+def test_similar_questions_with_other_numbers_do_not_match():
+    cache = AnswerCache(max_entries=10, ttl_seconds=60, similarity_threshold=0.9)
+    cache.put("What does error E12 mean?", [1.0, 0.0], "E12 answer", [], cache.scope())
+
+    assert cache.get_similar("What does error E13 mean?", [1.0, 0.0]) is None
+    assert cache.get_similar("what does error E12 mean", [1.0, 0.0])["answer"] == "E12 answer"
@@ -0,0 +1,13 @@
+import asyncio
+
+from src import api
+
+
+def test_updating_the_llm_call_limit_resizes_the_semaphore():
+    limit = api.llm_limit
+    try:
+        asyncio.run(api.update_settings({"MAX_CONCURRENT_LLM_CALLS": limit + 2}))
+        assert api.llm_semaphore._value == limit + 2
+    finally:
+        asyncio.run(api.update_settings({"MAX_CONCURRENT_LLM_CALLS": limit}))
+    assert api.llm_semaphore._value == limit
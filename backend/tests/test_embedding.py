@@ -0,0 +1,55 @@
+import uuid
+
+import chromadb
+from src.embedding import (get_chroma_client, get_embedding_function, get_existing_pdfs,
+                           get_pdf_chunk_ids, pdf_base_name)
+from src.embedding_cache import CachedEmbeddingFunction
+from src.settings import settings
+
+
+def make_collection(pdf_names):
+    """Returns a new in-memory collection with one chunk for each stored PDF name."""
+    collection = chromadb.EphemeralClient().create_collection(
+        f"test-{uuid.uuid4().hex}", embedding_function=None)
+    if pdf_names:
+        collection.add(
+            ids=[f"{pdf_name}:1" for pdf_name in pdf_names],
+            documents=[f"text of {pdf_name}" for pdf_name in pdf_names],
+            embeddings=[[1.0, 0.0]] * len(pdf_names),
+            metadatas=[{"pdf_name": pdf_name, "chunk_id": 1} for pdf_name in pdf_names],
+        )
+    return collection
+
+
+def test_pdf_base_name_strips_only_the_pdf_extension():
+    assert pdf_base_name("a.pdf") == "a"
+    assert pdf_base_name("a.b.pdf") == "a.b"
+    assert pdf_base_name("data/raw/manual.v2.pdf") == "manual.v2"
+
+
+def test_dotted_name_is_not_found_through_another_pdf():
+    collection = make_collection([pdf_base_name("a.pdf")])
+
+    assert get_existing_pdfs(collection, ["a.b"]) == set()
+    assert get_pdf_chunk_ids(collection, "a.b") == []
+    assert get_existing_pdfs(collection, ["a"]) == {"a"}
+
+
+def test_dotted_and_plain_names_are_kept_apart():
+    collection = make_collection([pdf_base_name("a.pdf"), pdf_base_name("a.b.pdf")])
+
+    assert get_existing_pdfs(collection, ["a", "a.b"]) == {"a", "a.b"}
+    assert get_pdf_chunk_ids(collection, "a.b") == ["a.b:1"]
+    assert get_pdf_chunk_ids(collection, "a") == ["a:1"]
+
+
+def test_collection_and_cache_settings_are_read_when_used(monkeypatch):
+    monkeypatch.setitem(settings, "COLLECTION_NAME", "renamed_collection")
+    _, collection = get_chroma_client()
+    assert collection.name == "renamed_collection"
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    monkeypatch.setitem(settings, "EMBEDDING_CACHE", False)
+    assert not isinstance(get_embedding_function(), CachedEmbeddingFunction)
+    monkeypatch.setitem(settings, "EMBEDDING_CACHE", True)
+    assert isinstance(get_embedding_function(), CachedEmbeddingFunction)
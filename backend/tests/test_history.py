@@ -0,0 +1,33 @@
+import asyncio
+from types import SimpleNamespace
+
+from src import history
+from src.chat_manager import append_chat_messages, get_chat_summary, init_chat_db
+from src.settings import settings
+
+
+class FakeLLM:
+    def __init__(self):
+        self.prompts = []
+
+    async def ainvoke(self, prompt):
+        self.prompts.append(prompt)
+        return SimpleNamespace(content=f"summary {len(self.prompts)}")
+
+
+def test_summary_folds_every_dropped_message_oldest_first(monkeypatch):
+    llm = FakeLLM()
+    monkeypatch.setattr(history, "get_llm", lambda: llm)
+    monkeypatch.setitem(settings, "HISTORY_SUMMARY", True)
+    monkeypatch.setitem(settings, "HISTORY_TOKEN_BUDGET", 50)
+    init_chat_db()
+    texts = [f"message {i} about the pump valve and its pressure rating" for i in range(40)]
+    append_chat_messages("long-chat", [{"sender": "user", "text": text} for text in texts])
+
+    asyncio.run(history.refresh_summary("long-chat", 41))
+
+    assert len(llm.prompts) > 1
+    folded = "\n".join(llm.prompts)
+    assert all(f"user: {text}" in folded for text in texts)
+    assert folded.index(texts[0]) < folded.index(texts[-1])
+    assert get_chat_summary("long-chat") == (40, f"summary {len(llm.prompts)}")
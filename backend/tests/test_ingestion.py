@@ -0,0 +1,137 @@
+import os
+
+import pytest
+from benchmarks.e2e_benchmark import write_pdf
+from benchmarks.fakes import FakeEmbeddingFunction
+from src import ingestion
+from src.embedding import (get_chroma_client, get_keyword_index, get_pdf_chunk_ids,
+                           pdf_base_name, rebuild_keyword_index)
+from src.embedding_cache import CachedEmbeddingFunction
+from src.keyword_index import KeywordIndex
+from src.preprocessing import RAW_DIR, process_pdf
+from src.settings import settings
+
+
+@pytest.fixture
+def embedding_function(monkeypatch):
+    embedding_function = FakeEmbeddingFunction(dim=16, latency=0)
+    monkeypatch.setattr(ingestion, "get_embedding_function", lambda: embedding_function)
+    return embedding_function
+
+
+def run(pdf_names=None):
+    """Runs an ingestion job in the calling thread and returns its status."""
+    job_id = ingestion.enqueue_job(pdf_names)
+    ingestion.run_job(job_id, pdf_names, False)
+    return ingestion.get_job(job_id)
+
+
+@pytest.mark.parametrize("pdf_names", [["guide.v2.pdf"], ["manual.pdf", "manual.v2.pdf"]])
+def test_second_job_is_a_no_op_for_dotted_file_names(embedding_function, pdf_names):
+    os.makedirs(RAW_DIR, exist_ok=True)
+    for pdf_name in pdf_names:
+        write_pdf(os.path.join(RAW_DIR, pdf_name),
+                  [[f"{pdf_name} page {page} line {line} pump valve" for line in range(5)]
+                   for page in range(2)])
+
+    first = run(pdf_names)
+    assert first["documents"]["total"] == len(pdf_names)
+    assert first["documents"].get("done") == len(pdf_names)
+
+    _, collection = get_chroma_client()
+    stored = {name: len(get_pdf_chunk_ids(collection, name))
+              for name in map(pdf_base_name, pdf_names)}
+    assert all(stored.values())
+
+    calls = embedding_function.stats.calls
+    second = run(pdf_names)
+    assert second["documents"]["total"] == 0
+    assert embedding_function.stats.calls == calls
+    assert {name: len(get_pdf_chunk_ids(collection, name)) for name in stored} == stored
+
+
+def test_recovered_keyword_index_only_holds_embedded_chunks(embedding_function):
+    os.makedirs(RAW_DIR, exist_ok=True)
+    write_pdf(os.path.join(RAW_DIR, "embedded.pdf"), [["embedded pump valve"]])
+    write_pdf(os.path.join(RAW_DIR, "orphan.pdf"), [["orphan pump valve"]])
+    run(["embedded.pdf"])
+    # Extracted but never embedded, as after a crash between the two steps.
+    process_pdf("orphan.pdf")
+
+    rebuild_keyword_index()
+
+    hits = {chunk_id for chunk_id, _ in get_keyword_index().search("pump valve", 10)}
+    _, collection = get_chroma_client()
+    assert hits
+    assert hits <= set(collection.get(include=[])["ids"])
+    assert not get_keyword_index().search("orphan", 10)
+
+
+def test_job_updating_several_pdfs_saves_the_keyword_index_once(embedding_function, monkeypatch):
+    pdf_names = [f"update{i}.pdf" for i in range(3)]
+    os.makedirs(RAW_DIR, exist_ok=True)
+    for version in ("old", "new"):
+        for pdf_name in pdf_names:
+            write_pdf(os.path.join(RAW_DIR, pdf_name), [[f"{version} text of {pdf_name}"]])
+        if version == "old":
+            run(pdf_names)
+
+    saves = []
+    save = KeywordIndex.save
+    monkeypatch.setattr(KeywordIndex, "save", lambda index, path: saves.append(path) or save(index, path))
+    job = run(pdf_names)
+
+    assert job["documents"].get("done") == 3
+    assert len(saves) == 1
+    assert not get_keyword_index().search("old", 10)
+
+
+def test_changed_pdf_without_text_loses_its_old_embeddings(embedding_function):
+    os.makedirs(RAW_DIR, exist_ok=True)
+    path = os.path.join(RAW_DIR, "emptied.pdf")
+    write_pdf(path, [["emptied gearbox lubricant"]])
+    run(["emptied.pdf"])
+    _, collection = get_chroma_client()
+    assert get_pdf_chunk_ids(collection, "emptied")
+
+    write_pdf(path, [[]])
+    job = run(["emptied.pdf"])
+
+    assert job["documents"].get("skipped") == 1
+    assert get_pdf_chunk_ids(collection, "emptied") == []
+    assert not get_keyword_index().search("gearbox lubricant", 10)
+
+
+def test_job_reports_its_embedding_cache_hits_and_misses(monkeypatch):
+    monkeypatch.setattr(ingestion, "get_embedding_function", lambda: CachedEmbeddingFunction(
+        FakeEmbeddingFunction(dim=16, latency=0), "fake"))
+    os.makedirs(RAW_DIR, exist_ok=True)
+    write_pdf(os.path.join(RAW_DIR, "cached.pdf"),
+              [[f"page {page} line {line} pump valve" for line in range(5)] for page in range(2)])
+
+    first = run(["cached.pdf"])
+    chunks = first["chunks_done"]
+    assert chunks > 0
+    assert first["embedding_cache"] == {"hits": 0, "misses": chunks}
+
+    job_id = ingestion.enqueue_job(["cached.pdf"], rebuild=True)
+    ingestion.run_job(job_id, ["cached.pdf"], True)
+    assert ingestion.get_job(job_id)["embedding_cache"] == {"hits": chunks, "misses": 0}
+
+
+def test_retry_settings_are_read_when_a_job_runs(monkeypatch):
+    def fail(input):
+        raise RuntimeError("embedding service unavailable")
+
+    monkeypatch.setattr(ingestion, "get_embedding_function", lambda: fail)
+    monkeypatch.setitem(settings, "INGESTION_MAX_RETRIES", 1)
+    monkeypatch.setitem(settings, "INGESTION_RETRY_BACKOFF", 0)
+    os.makedirs(RAW_DIR, exist_ok=True)
+    write_pdf(os.path.join(RAW_DIR, "unreachable.pdf"), [["pump valve"]])
+
+    job_id = ingestion.enqueue_job(["unreachable.pdf"])
+    ingestion.run_job(job_id, ["unreachable.pdf"], False)
+
+    task, = ingestion.get_job(job_id, include_tasks=True)["tasks"]
+    assert task["status"] == "failed"
+    assert task["attempts"] == 2
@@ -0,0 +1,19 @@
+import os
+
+from benchmarks.e2e_benchmark import write_pdf
+from src import preprocessing
+
+
+def test_single_pdf_is_extracted_outside_the_calling_process(monkeypatch, tmp_path):
+    pdf_path = os.path.join(tmp_path, "manual.pdf")
+    write_pdf(pdf_path, [["pump valve maintenance"]])
+
+    def extract_here(pdf_path):
+        raise AssertionError("extracted in the calling process")
+
+    # Spawned workers import the module afresh and keep the real extractor.
+    monkeypatch.setattr(preprocessing, "extract_pages_from_pdf", extract_here)
+
+    chunks = list(preprocessing.extract_chunks_parallel([pdf_path], workers=1))
+    assert len(chunks) == 1
+    assert chunks[0] and "pump valve" in chunks[0][0]["text"]
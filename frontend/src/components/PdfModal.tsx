@@ -55,7 +55,7 @@ const PDFModal: React.FC<PDFModalProps> = ({ setPdfModalOpen }) => {
     setProcessing(true);
     try {
       await axios.post('http://127.0.0.1:8000/process-pdfs/');
-      alert('All PDFs processed successfully!');
+      alert('PDF processing started in the background.');
       fetchPDFs();
     } catch (error) {
       console.error('Error processing PDFs:', error);